@@ -0,0 +1,645 @@
+#!/usr/bin/env python3
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+"""Benchmark of es-loader parse pipeline with synthetic logs.
+
+S3, OpenSearch と GeoIP をスタブにして、合成したログを
+LogS3 -> LogParser -> json の順で処理し、性能を計測する。
+コミット間で比較できるように結果を JSON で保存し、比較できる
+
+usage:
+    python3 benchmark.py --output result.json
+    python3 benchmark.py --baseline result.json --threshold 10
+"""
+__copyright__ = ('Copyright Amazon.com, Inc. or its affiliates. '
+                 'All Rights Reserved.')
+__version__ = '2.10.4'
+__license__ = 'MIT-0'
+__author__ = 'Akihiro Nakajima'
+__url__ = 'https://github.com/aws-samples/siem-on-amazon-opensearch-service'
+
+import argparse
+import gzip
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ACCOUNT = '123456789012'
+REGION = 'us-east-1'
+
+
+###############################################################################
+# synthetic corpus
+###############################################################################
+def random_ip(rand):
+    return (f'{rand.choice([3, 8, 52, 54, 203])}.{rand.randint(0, 255)}.'
+            f'{rand.randint(0, 255)}.{rand.randint(1, 254)}')
+
+
+def random_user_agent(rand):
+    return rand.choice([
+        'aws-cli/2.15.0 Python/3.11.6 Linux/5.10 exe/x86_64.amzn.2',
+        ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+         '(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'),
+        'Boto3/1.34.131 md/Botocore#1.34.131 ua/2.0 os/linux#5.10',
+        'console.amazonaws.com'])
+
+
+def create_cloudtrail(rand, count):
+    records = []
+    for i in range(count):
+        records.append({
+            'eventVersion': '1.09',
+            'userIdentity': {
+                'type': 'AssumedRole', 'principalId': f'AROAEXAMPLE:{i % 13}',
+                'arn': (f'arn:aws:sts::{ACCOUNT}:assumed-role/role{i % 5}/'
+                        f'session{i % 13}'),
+                'accountId': ACCOUNT, 'accessKeyId': f'ASIAEXAMPLE{i % 17}',
+                'sessionContext': {
+                    'sessionIssuer': {
+                        'type': 'Role', 'principalId': 'AROAEXAMPLE',
+                        'arn': f'arn:aws:iam::{ACCOUNT}:role/role{i % 5}',
+                        'accountId': ACCOUNT, 'userName': f'role{i % 5}'},
+                    'attributes': {
+                        'creationDate': '2024-05-01T11:00:00Z',
+                        'mfaAuthenticated': 'false'}}},
+            'eventTime': f'2024-05-01T12:{i % 60:02d}:{i * 7 % 60:02d}Z',
+            'eventSource': rand.choice(
+                ['s3.amazonaws.com', 'ec2.amazonaws.com',
+                 'sts.amazonaws.com', 'kms.amazonaws.com']),
+            'eventName': rand.choice(
+                ['GetObject', 'DescribeInstances', 'AssumeRole', 'Decrypt']),
+            'awsRegion': REGION,
+            'sourceIPAddress': random_ip(rand),
+            'userAgent': random_user_agent(rand),
+            'requestParameters': {
+                'bucketName': f'bucket{i % 3}', 'key': f'path/to/{i}.json',
+                'encryptionContext': None, 'filter': ''},
+            'responseElements': None,
+            'requestID': f'{i:016X}',
+            'eventID': f'00000000-0000-0000-0000-{i:012d}',
+            'readOnly': True,
+            'resources': [{'type': 'AWS::S3::Object',
+                           'ARN': f'arn:aws:s3:::bucket{i % 3}/{i}.json'}],
+            'eventType': 'AwsApiCall',
+            'managementEvent': False,
+            'recipientAccountId': ACCOUNT,
+            'eventCategory': 'Data',
+            'tlsDetails': {'tlsVersion': 'TLSv1.3',
+                           'cipherSuite': 'TLS_AES_128_GCM_SHA256',
+                           'clientProvidedHostHeader': 's3.amazonaws.com'}})
+    s3key = (f'AWSLogs/{ACCOUNT}/CloudTrail/{REGION}/2024/05/01/'
+             f'{ACCOUNT}_CloudTrail_{REGION}_20240501T1200Z_bench.json.gz')
+    return s3key, gzip.compress(json.dumps({'Records': records}).encode())
+
+
+def create_vpcflowlogs(rand, count):
+    lines = ['version account-id interface-id srcaddr dstaddr srcport '
+             'dstport protocol packets bytes start end action log-status']
+    for i in range(count):
+        lines.append(
+            f'2 {ACCOUNT} eni-0123456789abcdef{i % 10} {random_ip(rand)} '
+            f'10.0.{i % 4}.{i % 250 + 1} {rand.randint(1024, 65535)} '
+            f'{rand.choice([22, 443, 3389, 8080])} 6 {rand.randint(1, 99)} '
+            f'{rand.randint(40, 99999)} {1714564800 + i} {1714564860 + i} '
+            f'{rand.choice(["ACCEPT", "REJECT"])} OK')
+    s3key = (f'AWSLogs/{ACCOUNT}/vpcflowlogs/{REGION}/2024/05/01/'
+             f'{ACCOUNT}_vpcflowlogs_{REGION}_fl-0123456789abcdef0_'
+             '20240501T1200Z_bench.log.gz')
+    return s3key, gzip.compress(('\n'.join(lines) + '\n').encode())
+
+
+def create_alb(rand, count):
+    lines = []
+    for i in range(count):
+        lines.append(
+            f'https 2024-05-01T12:{i % 60:02d}:{i * 7 % 60:02d}.186641Z '
+            f'app/my-alb/50dc6c495c0c9188 {random_ip(rand)}:'
+            f'{rand.randint(1024, 65535)} 10.0.0.{i % 250 + 1}:80 '
+            f'0.000 0.{rand.randint(1, 999):03d} 0.000 200 200 '
+            f'{rand.randint(0, 999)} {rand.randint(100, 99999)} '
+            f'"GET https://www.example.com:443/path/{i}?q={i % 7} HTTP/1.1" '
+            f'"{random_user_agent(rand)}" ECDHE-RSA-AES128-GCM-SHA256 TLSv1.2 '
+            f'arn:aws:elasticloadbalancing:{REGION}:{ACCOUNT}:targetgroup/'
+            'tg/73e2d6bc24d8a067 "Root=1-58337262-36d228ad5d99923122bbe354" '
+            f'"www.example.com" "arn:aws:acm:{REGION}:{ACCOUNT}:certificate/'
+            '12345678-1234-1234-1234-123456789012" 0 '
+            '2024-05-01T12:00:00.000000Z "forward" "-" "-" '
+            f'"10.0.0.{i % 250 + 1}:80" "200" "-" "-"')
+    s3key = (f'AWSLogs/{ACCOUNT}/elasticloadbalancing/{REGION}/2024/05/01/'
+             f'{ACCOUNT}_elasticloadbalancing_{REGION}_app.my-alb.'
+             '50dc6c495c0c9188_20240501T1200Z_10.0.0.1_bench.log.gz')
+    return s3key, gzip.compress(('\n'.join(lines) + '\n').encode())
+
+
+def create_waf(rand, count):
+    lines = []
+    for i in range(count):
+        lines.append(json.dumps({
+            'timestamp': 1714564800000 + i * 10,
+            'formatVersion': 1,
+            'webaclId': (f'arn:aws:wafv2:{REGION}:{ACCOUNT}:regional/webacl/'
+                         'bench/01234567-89ab-cdef-0123-456789abcdef'),
+            'terminatingRuleId': 'Default_Action',
+            'terminatingRuleType': 'REGULAR',
+            'action': rand.choice(['ALLOW', 'BLOCK']),
+            'terminatingRuleMatchDetails': [],
+            'httpSourceName': 'ALB',
+            'httpSourceId': f'{ACCOUNT}-app/my-alb/50dc6c495c0c9188',
+            'ruleGroupList': [{
+                'ruleGroupId': 'AWS#AWSManagedRulesCommonRuleSet',
+                'terminatingRule': None, 'nonTerminatingMatchingRules': [],
+                'excludedRules': None}],
+            'rateBasedRuleList': [],
+            'nonTerminatingMatchingRules': [],
+            'requestHeadersInserted': None,
+            'responseCodeSent': None,
+            'httpRequest': {
+                'clientIp': random_ip(rand), 'country': 'US',
+                'headers': [
+                    {'name': 'Host', 'value': 'www.example.com'},
+                    {'name': 'User-Agent', 'value': random_user_agent(rand)},
+                    {'name': 'Accept', 'value': '*/*'}],
+                'uri': f'/path/{i}', 'args': f'q={i % 7}',
+                'httpVersion': 'HTTP/1.1', 'httpMethod': 'GET',
+                'requestId': f'1-{i:08x}-0123456789abcdef01234567'}}))
+    s3key = (f'AWSLogs/{ACCOUNT}/WAFLogs/{REGION}/aws-waf-logs-bench/2024/05/'
+             f'01/12/00/{ACCOUNT}_waflogs_{REGION}_bench_20240501T1200Z_'
+             'bench.log.gz')
+    return s3key, gzip.compress(('\n'.join(lines) + '\n').encode())
+
+
+def create_guardduty(rand, count):
+    lines = []
+    for i in range(count):
+        lines.append(json.dumps({
+            'schemaVersion': '2.0', 'accountId': ACCOUNT, 'region': REGION,
+            'partition': 'aws', 'id': f'{i:032x}',
+            'arn': (f'arn:aws:guardduty:{REGION}:{ACCOUNT}:detector/bench/'
+                    f'finding/{i:032x}'),
+            'type': 'Recon:EC2/PortProbeUnprotectedPort',
+            'resource': {
+                'resourceType': 'Instance',
+                'instanceDetails': {
+                    'instanceId': f'i-0123456789abcdef{i % 10}',
+                    'instanceType': 't3.micro',
+                    'networkInterfaces': [{
+                        'privateIpAddress': f'10.0.0.{i % 250 + 1}',
+                        'publicIp': random_ip(rand)}]}},
+            'service': {
+                'serviceName': 'guardduty', 'detectorId': 'bench',
+                'action': {
+                    'actionType': 'PORT_PROBE',
+                    'portProbeAction': {
+                        'blocked': False,
+                        'portProbeDetails': [{
+                            'localPortDetails': {'port': 22,
+                                                 'portName': 'SSH'},
+                            'remoteIpDetails': {
+                                'ipAddressV4': random_ip(rand),
+                                'country': {'countryName': 'Unknown'}}}]}},
+                'eventFirstSeen': '2024-05-01T11:00:00.000Z',
+                'eventLastSeen': '2024-05-01T12:00:00.000Z',
+                'archived': False, 'count': rand.randint(1, 99)},
+            'severity': rand.choice([2, 5, 8]),
+            'createdAt': '2024-05-01T12:00:00.000Z',
+            'updatedAt': f'2024-05-01T12:{i % 60:02d}:00.000Z',
+            'title': 'Unprotected port on EC2 instance is being probed.',
+            'description': 'EC2 instance has an unprotected port.'}))
+    s3key = (f'AWSLogs/{ACCOUNT}/GuardDuty/{REGION}/2024/05/01/'
+             'bench.jsonl.gz')
+    return s3key, gzip.compress(('\n'.join(lines) + '\n').encode())
+
+
+def create_cwl_linux(rand, count):
+    body = b''
+    events_per_message = 100
+    for j in range(0, count, events_per_message):
+        events = []
+        for k in range(j, min(j + events_per_message, count)):
+            events.append({
+                'id': f'{k:056d}', 'timestamp': 1714564800000 + k,
+                'message': (f'May  1 12:{k % 60:02d}:{k * 7 % 60:02d} '
+                            f'ip-10-0-0-1 sshd[{1000 + k}]: Failed password '
+                            f'for invalid user u{k % 9} from '
+                            f'{random_ip(rand)} port '
+                            f'{rand.randint(1024, 65535)} ssh2')})
+        body += json.dumps({
+            'messageType': 'DATA_MESSAGE', 'owner': ACCOUNT,
+            'logGroup': '/ec2/linux/secure',
+            'logStream': 'i-0123456789abcdef0',
+            'subscriptionFilters': ['bench'], 'logEvents': events}).encode()
+    s3key = (f'AWSLogs/{ACCOUNT}/EC2/Linux/Secure/{REGION}/2024/05/01/'
+             'bench.gz')
+    return s3key, gzip.compress(body)
+
+
+def create_securitylake(rand, count):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        return None, None
+    table = pa.table({
+        'time': [1714564800000 + i for i in range(count)],
+        'class_uid': [3005] * count,
+        'category_uid': [3] * count,
+        'category_name': ['Identity & Access Management'] * count,
+        'activity_name': ['Read'] * count,
+        'severity': ['Informational'] * count,
+        'src_endpoint': [{'ip': random_ip(rand), 'domain': None}
+                         for i in range(count)],
+        'api': [{'operation': 'GetObject',
+                 'service': {'name': 's3.amazonaws.com'},
+                 'request': {'uid': f'{i:016X}'}} for i in range(count)],
+        'actor': [{'user': {'type': 'AssumedRole', 'uid': f'AROA:{i % 13}',
+                            'account_uid': ACCOUNT}} for i in range(count)],
+        'http_request': [{'user_agent': random_user_agent(rand)}
+                         for i in range(count)],
+        'cloud': [{'provider': 'AWS', 'region': REGION,
+                   'account_uid': ACCOUNT} for i in range(count)],
+        'metadata': [{'uid': f'00000000-0000-0000-0000-{i:012d}',
+                      'version': '1.0.0-rc.2',
+                      'product': {'name': 'CloudTrail', 'vendor_name': 'AWS',
+                                  'version': '1.09'}}
+                     for i in range(count)],
+        'resources': [[{'uid': f'arn:aws:s3:::bucket{i % 3}',
+                        'type': 'AWS::S3::Bucket'}] for i in range(count)]})
+    buf = io.BytesIO()
+    pq.write_table(table, buf, row_group_size=10000)
+    s3key = (f'aws-security-data-lake-{REGION}-bench/aws/CLOUD_TRAIL_MGMT/'
+             f'1.0/region={REGION}/accountId={ACCOUNT}/eventDay=20240501/'
+             '0123456789abcdef0123456789abcdef.gz.parquet')
+    return s3key, buf.getvalue()
+
+
+CORPUS_CREATORS = {
+    'cloudtrail': create_cloudtrail,
+    'vpcflowlogs': create_vpcflowlogs,
+    'alb': create_alb,
+    'waf': create_waf,
+    'guardduty': create_guardduty,
+    'cwl_linux': create_cwl_linux,
+    'securitylake': create_securitylake,
+}
+
+
+###############################################################################
+# stub
+###############################################################################
+class StubBody:
+    def __init__(self, data):
+        self._body = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self._body.read(size)
+
+    def close(self):
+        pass
+
+
+class StubS3Client:
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        data = self.objects[Key]
+        if Range:
+            start, end = Range.split('=')[1].split('-')
+            end = int(end) + 1 if end else len(data)
+            data = data[int(start):end]
+        return {'Body': StubBody(data), 'ContentLength': len(data),
+                'ResponseMetadata': {
+                    'HTTPHeaders': {'content-length': str(len(data))}}}
+
+
+def import_es_loader():
+    os.environ.setdefault('ENDPOINT',
+                          f'search-bench.{REGION}.aoss.amazonaws.com')
+    os.environ.setdefault('AWS_DEFAULT_REGION', REGION)
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    os.environ.pop('AWS_EXECUTION_ENV', None)
+    os.chdir(BENCHMARK_DIR)
+    sys.path.insert(0, BENCHMARK_DIR)
+    import index
+    logging.getLogger().setLevel(logging.CRITICAL)
+    for name in list(logging.root.manager.loggerDict):
+        logging.getLogger(name).setLevel(logging.CRITICAL)
+    index.logger.setLevel(logging.CRITICAL)
+    return index
+
+
+###############################################################################
+# benchmark
+###############################################################################
+def run_once(index, s3key, data):
+    stub = StubS3Client({s3key: data})
+    index.s3_client = stub
+    index.control_tower_s3_client = stub
+    index.security_lake_s3_client = stub
+
+    bucket = s3key.split('/')[0] if 'security-data-lake' in s3key else 'b'
+    record = {'s3': {'bucket': {'name': bucket},
+                     'object': {'key': s3key, 'size': len(data)}}}
+    count = 0
+    output_size = 0
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    logfile = index.extract_logfile_from_s3(record)
+    for indexname, docid, source in index.get_es_entries(logfile):
+        count += 1
+        output_size += len(source)
+    elapsed = time.perf_counter() - start
+    cpu_time = time.process_time() - cpu_start
+    # same stages as metrics of es-loader
+    stages = {k: round(v * 1000, 2) for k, v in logfile.stage_elapsed.items()}
+    return {'count': count, 'output_size': output_size,
+            'elapsed': elapsed, 'cpu_time': cpu_time, 'stages_ms': stages}
+
+
+def benchmark_logtype(args):
+    name, records, repeat, seed = args
+    s3key, data = CORPUS_CREATORS[name](random.Random(seed), records)
+    if s3key is None:
+        return name, None
+    index = import_es_loader()
+    # 1st run is warm up for lru_cache and compiled regex
+    run_once(index, s3key, data)
+    best = None
+    for i in range(repeat):
+        result = run_once(index, s3key, data)
+        if best is None or result['elapsed'] < best['elapsed']:
+            best = result
+    return name, {
+        'records': best['count'],
+        'input_bytes': len(data),
+        'output_bytes': best['output_size'],
+        'elapsed_ms': round(best['elapsed'] * 1000, 2),
+        'records_per_sec': round(best['count'] / best['elapsed'], 1),
+        'input_bytes_per_sec': round(len(data) / best['elapsed'], 1),
+        'cpu_ms_per_record': round(
+            best['cpu_time'] * 1000 / max(best['count'], 1), 4),
+        # kilobytes on Linux
+        'peak_rss_mb': round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'stages_ms': best['stages_ms'],
+    }
+
+
+def create_trusted_proxy_db(rand, count):
+    # same schema as trusted_proxy.db created by geoip_downloader
+    conn = sqlite3.connect(':memory:')
+    cur = conn.cursor()
+    cur.execute(
+        """CREATE TABLE ipaddress(
+            provider TEXT, name TEXT, version INTEGER,
+            v6_network1_start INTEGER, v6_network1_end INTEGER,
+            v6_network2_start INTEGER, v6_network2_end INTEGER,
+            network_start INTEGER, network_end INTEGER)""")
+    for i in range(count):
+        if rand.random() < 0.8:
+            prefixlen = rand.randint(16, 28)
+            network_start = (rand.getrandbits(32) >> (32 - prefixlen)
+                             << (32 - prefixlen))
+            network_end = network_start | ((1 << (32 - prefixlen)) - 1)
+            row = (4, 0, 0, 0, 0, network_start, network_end)
+        else:
+            prefixlen = rand.randint(32, 64)
+            network_start = ((0x2600 << 112 | rand.getrandbits(112))
+                             >> (128 - prefixlen) << (128 - prefixlen))
+            network_end = network_start | ((1 << (128 - prefixlen)) - 1)
+            row = (6, network_start >> 80, network_end >> 80,
+                   (network_start >> 32) & ((1 << 48) - 1),
+                   (network_end >> 32) & ((1 << 48) - 1),
+                   network_start & ((1 << 32) - 1),
+                   network_end & ((1 << 32) - 1))
+        cur.execute('INSERT INTO ipaddress VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    ('cloudfront', f'network{i}') + row)
+    return conn, cur
+
+
+def benchmark_xff(records, repeat, seed):
+    """compare trusted proxy lookup of sorted ranges with SQLite query"""
+    import_es_loader()
+    from siem import xff
+    rand = random.Random(seed)
+    xff_instance = xff.DB.__new__(xff.DB)
+    xff_instance.conn, xff_instance.cur = create_trusted_proxy_db(rand, 2000)
+    xff_instance.trusted_networks = (
+        xff_instance._create_trusted_network_table())
+    ips = []
+    for i in range(records):
+        if rand.random() < 0.8:
+            ips.append(random_ip(rand))
+        else:
+            ips.append(f'2600:{rand.getrandbits(16):x}::{rand.randint(1, 99)}')
+    results = {}
+    for name, func in (('sqlite', xff_instance._query_db),
+                       ('sorted_range', xff_instance._match_trusted_network)):
+        best = None
+        for i in range(repeat):
+            start = time.perf_counter()
+            matched = sum(1 for ip in ips if func(ip))
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = {'lookups': len(ips), 'matched': matched,
+                         'lookups_per_sec': round(len(ips) / best, 1)}
+    return results
+
+
+def benchmark_exclusion_conditions(records, repeat, seed, conditions=50):
+    """compare JMESPath interpreter with compiled python predicates"""
+    import_es_loader()
+    import jmespath
+    from siem import utils
+    rand = random.Random(seed)
+    templates = [
+        "eventName == 'GetObject' && requestParameters.bucketName == "
+        "'bucket{n}'",
+        "contains(userIdentity.arn, 'role{n}/') && "
+        "eventSource == 'kms.amazonaws.com'",
+        "starts_with(userAgent, 'Boto3') && sourceIPAddress == '3.0.0.{n}'",
+        "userIdentity.sessionContext.sessionIssuer.userName == 'user{n}' "
+        "|| eventName == 'Delete{n}'",
+        "!(readOnly) && awsRegion != 'ap-northeast-{n}'"]
+    expressions = [jmespath.compile(templates[i % len(templates)].format(
+        n=i // len(templates))) for i in range(conditions)]
+    logs = json.loads(gzip.decompress(
+        create_cloudtrail(rand, records)[1]))['Records']
+    results = {}
+    for name, funcs in (
+            ('interpreter', [x.search for x in expressions]),
+            ('compiled', [utils.compile_jmespath_predicate(x)
+                          for x in expressions])):
+        best = None
+        for i in range(repeat):
+            start = time.perf_counter()
+            matched = sum(1 for log in logs for func in funcs if func(log))
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = {'records': len(logs), 'conditions': len(funcs),
+                         'matched': matched,
+                         'us_per_record': round(best / len(logs) * 1e6, 2)}
+    return results
+
+
+def report_import_time(top):
+    """show import time of es-loader like python -X importtime"""
+    env = dict(os.environ)
+    env.setdefault('ENDPOINT', f'search-bench.{REGION}.aoss.amazonaws.com')
+    env.setdefault('AWS_DEFAULT_REGION', REGION)
+    env.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    env.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    env.pop('AWS_EXECUTION_ENV', None)
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import siem'],
+        cwd=BENCHMARK_DIR, env=env, capture_output=True, text=True)
+    # import time: self [us] | cumulative | imported package
+    # nested imports are indented and printed before the parent
+    modules = []
+    total = 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[12:].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth > 0:
+            modules.append((name.strip(), depth, int(cumulative_us)))
+        elif name.strip() == 'siem':
+            total = int(cumulative_us)
+            break
+        else:
+            # modules imported by python itself before siem
+            modules = []
+    print(f'import siem: {total / 1000:.1f} ms')
+    print(f'{"module":<40}{"cumulative ms":>14}')
+    for name, depth, cumulative_us in sorted(
+            [x for x in modules if x[1] <= 2], key=lambda x: -x[2])[:top]:
+        print(f'{"  " * (depth - 1) + name:<40}{cumulative_us / 1000:>14.1f}')
+    return total
+
+
+def print_results(results, baseline=None):
+    print(f'{"logtype":<14}{"records":>9}{"rec/s":>11}{"MB/s":>8}'
+          f'{"cpu ms/rec":>12}{"RSS MB":>8}{"vs base":>9}')
+    for name, result in results.items():
+        if result is None:
+            print(f'{name:<14} skipped')
+            continue
+        diff = ''
+        if baseline and baseline.get(name):
+            base = baseline[name]['records_per_sec']
+            diff = f'{(result["records_per_sec"] - base) / base * 100:+.1f}%'
+        print(f'{name:<14}{result["records"]:>9}'
+              f'{result["records_per_sec"]:>11.0f}'
+              f'{result["input_bytes_per_sec"] / 1048576:>8.2f}'
+              f'{result["cpu_ms_per_record"]:>12.4f}'
+              f'{result["peak_rss_mb"]:>8.1f}{diff:>9}')
+        stages = ', '.join(
+            f'{k}={v}' for k, v in sorted(
+                result['stages_ms'].items(), key=lambda x: -x[1]) if v >= 1)
+        print(f'{"":<14}stages(ms): {stages}')
+
+
+def check_args():
+    parser = argparse.ArgumentParser(
+        description='benchmark of es-loader parse pipeline')
+    parser.add_argument(
+        '-l', '--logtype', action='append', choices=list(CORPUS_CREATORS),
+        help='logtype to benchmark. default is all')
+    parser.add_argument('-n', '--records', type=int, default=20000,
+                        help='number of records in each synthetic log file')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='number of runs. the fastest run is reported')
+    parser.add_argument('-s', '--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', help='save results to JSON file')
+    parser.add_argument('-b', '--baseline',
+                        help='JSON file of previous results to compare with')
+    parser.add_argument(
+        '-x', '--xff', action='store_true',
+        help='benchmark trusted proxy lookup instead of parse pipeline')
+    parser.add_argument(
+        '-j', '--jmespath', action='store_true',
+        help=('benchmark JMESPath exclusion conditions instead of parse '
+              'pipeline'))
+    parser.add_argument(
+        '-i', '--import-time', action='store_true',
+        help='report import time of siem package instead of parse pipeline')
+    parser.add_argument(
+        '-t', '--threshold', type=float, default=10,
+        help=('exit with 1 if records/sec drops more than this percentage '
+              'from baseline'))
+    return parser.parse_args()
+
+
+def main():
+    args = check_args()
+    if args.import_time:
+        report_import_time(top=20)
+        return
+    if args.xff:
+        results = benchmark_xff(args.records, args.repeat, args.seed)
+        for name, result in results.items():
+            print(f'{name:<14}{result["lookups"]:>9} lookups'
+                  f'{result["lookups_per_sec"]:>12.0f} lookups/s'
+                  f'{result["matched"]:>9} matched')
+        return
+    if args.jmespath:
+        results = benchmark_exclusion_conditions(
+            args.records, args.repeat, args.seed)
+        for name, result in results.items():
+            print(f'{name:<14}{result["records"]:>9} records'
+                  f'{result["conditions"]:>5} conditions'
+                  f'{result["us_per_record"]:>10.2f} us/rec'
+                  f'{result["matched"]:>9} matched')
+        return
+    logtypes = args.logtype or list(CORPUS_CREATORS)
+    results = {}
+    # each logtype runs in a fresh process to measure its own peak RSS
+    context = multiprocessing.get_context('spawn')
+    for name in logtypes:
+        with context.Pool(1) as pool:
+            name, result = pool.apply(
+                benchmark_logtype,
+                ((name, args.records, args.repeat, args.seed), ))
+        results[name] = result
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline_json = json.load(f)
+        baseline = baseline_json['results']
+        if baseline_json['records'] != args.records:
+            print(f'warning: baseline was measured with '
+                  f'{baseline_json["records"]} records')
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'version': __version__, 'records': args.records,
+                       'python': sys.version.split()[0],
+                       'results': results}, f, indent=2)
+
+    if baseline:
+        regressions = [
+            name for name, result in results.items()
+            if result and baseline.get(name)
+            and (result['records_per_sec']
+                 < baseline[name]['records_per_sec']
+                 * (1 - args.threshold / 100))]
+        if regressions:
+            print(f'performance regression: {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
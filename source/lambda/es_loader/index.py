@@ -11,11 +11,15 @@ __url__ = 'https://github.com/aws-samples/siem-on-amazon-opensearch-service'
 import json
 import logging
 import os
+import random
 import re
 import sys
+import threading
 import time
 import urllib.parse
 import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache, wraps
 
 import boto3
@@ -31,6 +35,7 @@ logging.getLogger('opensearch').setLevel(logging.ERROR)
 logger = Logger(stream=sys.stdout, log_record_order=["level", "message"])
 logger.info(f'version: {__version__}')
 logger.info(f'boto3: {boto3.__version__}')
+logger.info(f'json backend: {utils.JSON_BACKEND}')
 warnings.filterwarnings("ignore", "No metrics to publish*")
 metrics = Metrics()
 
@@ -46,6 +51,36 @@ if 'SQS_SPLITTED_LOGS_URL' in os.environ:
 ES_HOSTNAME = utils.get_es_hostname()
 SERVICE = ES_HOSTNAME.split('.')[2]
 AOSS_TYPE = os.getenv('AOSS_TYPE', '')
+# number of bulk requests which are sent to OpenSearch concurrently
+# while the next logs are being parsed
+BULK_CONCURRENCY = max(int(os.getenv('BULK_CONCURRENCY', 2)), 1)
+# size of bulk request is adjusted between BULK_SIZE_MIN and BULK_SIZE_MAX
+# by took and 429/503 of the responses. http.max_content_length is 10MiB
+# in small instance types, so raise BULK_SIZE_MAX only for large domains
+BULK_SIZE_MIN = 1000000
+BULK_SIZE_MAX = int(os.getenv('BULK_SIZE_MAX', 9000000))
+BULK_SIZE_STEP = 1000000
+BULK_TOOK_LOW = 1000    # ms
+BULK_TOOK_HIGH = 5000   # ms
+# learned size is kept across warm invocations
+bulk_size = min(6000000, BULK_SIZE_MAX)
+# logs which are rejected with 429/503 are sent again with jittered
+# exponential backoff while the lambda function has enough time
+BULK_RETRY_MAX = 5
+BULK_RETRY_BASE_WAIT = 0.5    # sec
+BULK_RETRY_MAX_WAIT = 16      # sec
+BULK_RETRY_TIME_MARGIN = 30   # sec
+lambda_deadline = None
+# independent network calls in initialization run concurrently. when a step
+# does not finish in its timeout, initialization goes on with default value
+INIT_TIMEOUT_API = float(os.getenv('INIT_TIMEOUT_API', 10))     # sec
+INIT_TIMEOUT_DOWNLOAD = float(os.getenv('INIT_TIMEOUT_DOWNLOAD', 60))   # sec
+# read-only indices (UltraWarm, cold and closed) are refreshed every TTL and
+# when bulk is rejected by write block. rejected logs go to the _NN index
+READ_ONLY_INDICES_TTL = int(os.getenv('READ_ONLY_INDICES_TTL', 300))   # sec
+BLOCKED_INDEX_ERRORS = ('cluster_block_exception',
+                        'index_create_block_exception',
+                        'index_closed_exception')
 docid_set = set()
 
 
@@ -148,7 +183,7 @@ def create_logconfig(logtype):
     type_re = ['s3_key_ignored', 'log_pattern', 'multiline_firstline',
                'xml_firstline', 'file_timestamp_format']
     type_int = ['max_log_count', 'text_header_line_number',
-                'ignore_header_line_number']
+                'ignore_header_line_number', 's3_streaming_threshold']
     type_bool = ['via_cwl', 'via_firelens', 'ignore_container_stderr',
                  'timestamp_nano']
     type_list = ['base.tags', 'clientip_xff', 'container.image.tag',
@@ -206,6 +241,7 @@ def create_logconfig(logtype):
         logconfig['exclusion_patterns'] = log_exclusion_patterns[logtype]
     if logtype in exclusion_conditions:
         logconfig['exclusion_conditions'] = exclusion_conditions[logtype]
+    logconfig['ecs_mapping_plan'] = utils.EcsMappingPlan(logconfig)
 
     return logconfig
 
@@ -265,11 +301,10 @@ def get_es_entries(logfile):
                 logger.debug(
                     f'Skipped log because {logparser.ignored_reason}')
             continue
-        indexname = utils.get_writable_indexname(
-            logparser.indexname, READ_ONLY_INDICES)
-        action_meta = {'index': {'_index': indexname, '_id': logparser.doc_id}}
+        indexname = read_only_indices.get_writable_indexname(
+            logparser.indexname)
         # logger.debug(logparser.json)
-        yield [action_meta, logparser.json]
+        yield indexname, logparser.doc_id, logparser.json
 
     del logparser
 
@@ -311,65 +346,192 @@ def check_es_results(results, total_count):
     return duration, success, error, error_reasons, retry
 
 
-def bulkloads_into_opensearch(es_entries, collected_metrics):
+@lru_cache(maxsize=1024)
+def get_bulk_action_prefix(indexname):
+    return b'{"index":{"_index":' + utils.json_dumps(indexname)
+
+
+def create_bulk_action(indexname, docid=None):
+    """return serialized bulk action line.
+
+    インデックス名の部分はキャッシュし、_id だけをエスケープして連結する
+    """
+    if docid is None:
+        return get_bulk_action_prefix(indexname) + b'}}\n'
+    return (get_bulk_action_prefix(indexname) + b',"_id":'
+            + utils.json_dumps(docid) + b'}}\n')
+
+
+def _bulk(body):
     global es_conn
-    global docid_set
-    output_size, total_output_size = 0, 0
-    total_count, success_count, error_count, es_response_time = 0, 0, 0, 0
-    results = False
-    putdata_list = []
-    error_reason_list = []
-    retry_needed = False
     filter_path = ['took', 'errors', 'items.index.status', 'items.index.error']
-    docid_list = []
-    for data in es_entries:
-        if AOSS_TYPE == 'TIMESERIES':
-            docid = data[0]['index'].pop('_id')
-            if docid in docid_set:
-                continue
-            docid_list.append(docid)
-        action_meta = json.dumps(data[0])
-        parsed_json = data[1]
-        putdata_list.extend([action_meta, parsed_json])
-        output_size += len(action_meta) + len(parsed_json)
-        # es の http.max_content_length は t2 で10MB なのでデータがたまったらESにロード
-        if output_size > 6000000:
-            total_output_size += output_size
-            try:
-                results = es_conn.bulk(putdata_list, filter_path=filter_path)
-            except (AuthorizationException, AuthenticationException) as err:
+    conn = es_conn
+    try:
+        results = conn.bulk(body, filter_path=filter_path)
+    except (AuthorizationException, AuthenticationException) as err:
+        # _bulk runs in threads of bulk_executor. the connection is recreated
+        # only once even if concurrent requests fail at the same time
+        with es_conn_lock:
+            if es_conn is conn:
                 logger.warning(
                     'AuthN or AuthZ Exception raised due to SigV4 issue. '
                     f'http_compress has been disabled. {err}')
                 es_conn = utils.create_es_conn(
                     awsauth, ES_HOSTNAME, http_compress=False)
-                results = es_conn.bulk(putdata_list, filter_path=filter_path)
-            es_took, success, error, error_reasons, retry = check_es_results(
-                results, total_count)
-            success_count += success
-            error_count += error
-            es_response_time += es_took
-            output_size = 0
-            total_count = success_count + error_count
-            putdata_list = []
-            if len(error_reasons):
-                error_reason_list.extend(error_reasons)
-            if retry:
-                retry_needed = True
-    if output_size > 0:
-        total_output_size += output_size
-        try:
-            results = es_conn.bulk(putdata_list, filter_path=filter_path)
-        except (AuthorizationException, AuthenticationException) as err:
-            logger.warning(
-                'AuthN or AuthZ Exception raised due to SigV4 issue. '
-                f'http_compress has been disabled. {err}')
-            es_conn = utils.create_es_conn(
-                awsauth, ES_HOSTNAME, http_compress=False)
-            results = es_conn.bulk(putdata_list, filter_path=filter_path)
+            conn = es_conn
+        results = conn.bulk(body, filter_path=filter_path)
+    return results
+
+
+def has_time_to_retry(wait):
+    if lambda_deadline is None:
+        # local execution
+        return True
+    return (lambda_deadline - time.monotonic() - wait
+            > BULK_RETRY_TIME_MARGIN)
+
+
+def reroute_blocked_logs(body, offsets, results):
+    """send logs rejected by write block to writable indices again.
+
+    read-only index を再取得し、ブロックされたインデックスが含まれていれば、
+    そのログだけ get_writable_indexname の _NN のインデックスに送り直す。
+    結果は items の同じ位置に上書きし、送り直したログに置き換えた body と
+    offsets を返す
+    """
+    blocked_indexes = [
+        i for i, item in enumerate(results['items'])
+        if (item['index'].get('error') or {}).get('type')
+        in BLOCKED_INDEX_ERRORS]
+    if not blocked_indexes:
+        return body, offsets
+    read_only_indices.refresh()
+    ends = offsets[1:] + [len(body)]
+    rerouted_logs = {}
+    for i in blocked_indexes:
+        log = body[offsets[i]:ends[i]]
+        action_end = log.index(b'\n') + 1
+        action = json.loads(log[:action_end])['index']
+        new_indexname = read_only_indices.get_writable_indexname(
+            action['_index'])
+        if new_indexname != action['_index']:
+            rerouted_logs[i] = (create_bulk_action(
+                new_indexname, action.get('_id')) + log[action_end:])
+    if not rerouted_logs:
+        return body, offsets
+    logger.info(f'{len(rerouted_logs)} of logs were rejected by write block. '
+                'They are sent to writable indices')
+    reroute_results = _bulk(b''.join(rerouted_logs.values()))
+    results['took'] += reroute_results['took']
+    for i, item in zip(rerouted_logs, reroute_results['items']):
+        results['items'][i] = item
+    results['errors'] = any(
+        item['index']['status'] >= 300 for item in results['items'])
+    new_body = bytearray()
+    new_offsets = []
+    for i, (start, end) in enumerate(zip(offsets, ends)):
+        new_offsets.append(len(new_body))
+        new_body += rerouted_logs.get(i, body[start:end])
+    return bytes(new_body), new_offsets
+
+
+def send_bulk_request(body, offsets):
+    """send bulk request and retry only logs rejected with 429/503.
+
+    offsets は body 内の各ログ (action 行と source 行) の開始位置。
+
+    再送したログの結果は元の items の同じ位置に上書きするので、
+    check_es_results の集計は変わらない。リトライ回数か Lambda の残り時間を
+    使い切った場合は 429/503 のまま返し、S3 オブジェクト単位でリトライされる。
+    書き込みがブロックされたログは reroute_blocked_logs で送り直す
+    """
+    results = _bulk(body)
+    results['retry_count'] = 0
+    if results['errors']:
+        body, offsets = reroute_blocked_logs(body, offsets, results)
+    while results['errors'] and results['retry_count'] < BULK_RETRY_MAX:
+        retry_indexes = [i for i, item in enumerate(results['items'])
+                         if item['index']['status'] in (429, 503)]
+        if not retry_indexes:
+            break
+        wait = random.uniform(0, min(
+            BULK_RETRY_MAX_WAIT,
+            BULK_RETRY_BASE_WAIT * 2 ** results['retry_count']))
+        if not has_time_to_retry(wait):
+            logger.warning('No time left to retry rejected logs')
+            break
+        time.sleep(wait)
+        results['retry_count'] += 1
+        logger.info(f'{len(retry_indexes)} of logs were rejected with '
+                    f'429/503. retry #{results["retry_count"]}')
+        ends = offsets[1:] + [len(body)]
+        retry_results = _bulk(b''.join(
+            body[offsets[i]:ends[i]] for i in retry_indexes))
+        results['took'] += retry_results['took']
+        for i, item in zip(retry_indexes, retry_results['items']):
+            results['items'][i] = item
+        results['errors'] = any(
+            item['index']['status'] >= 300 for item in results['items'])
+    return results
+
+
+def adjust_bulk_size(results):
+    """adjust size of next bulk requests by the response.
+
+    429/503 が返ってくる、または took が長い場合は半分にし、
+    took が短い場合は BULK_SIZE_STEP ずつ大きくする
+    """
+    global bulk_size
+    is_throttled = results.get('retry_count', 0) > 0
+    if results['errors'] and not is_throttled:
+        is_throttled = any(
+            item['index']['status'] in (429, 503)
+            for item in results['items'])
+    if is_throttled or results['took'] > BULK_TOOK_HIGH:
+        new_bulk_size = max(bulk_size // 2, BULK_SIZE_MIN)
+    elif results['took'] < BULK_TOOK_LOW:
+        new_bulk_size = min(bulk_size + BULK_SIZE_STEP, BULK_SIZE_MAX)
+    else:
+        new_bulk_size = bulk_size
+    if new_bulk_size != bulk_size:
+        logger.debug({'bulk_size': new_bulk_size, 'took': results['took'],
+                      'is_throttled': is_throttled})
+        bulk_size = new_bulk_size
+
+
+def bulkloads_into_opensearch(es_entries, collected_metrics):
+    """load es_entries into OpenSearch with concurrent bulk requests.
+
+    ログのパースを続けながら、最大 BULK_CONCURRENCY 個のバルクリクエストを
+    並行して送信する。上限に達した場合は最も古いリクエストの完了を待つ。
+    結果は送信した順に集計する
+    """
+    global docid_set
+    total_output_size = 0
+    total_count, success_count, error_count, es_response_time = 0, 0, 0, 0
+    # bulk body and start positions of each log in it
+    putdata = bytearray()
+    offsets = []
+    error_reason_list = []
+    retry_needed = False
+    docid_list = []
+    # (future, number of logs which were sent before the request)
+    in_flight = deque()
+    sent_count = 0
+    # time to wait for responses without parsing logs
+    bulk_wait_time = 0
+
+    def collect_oldest_result():
+        nonlocal success_count, error_count, es_response_time, total_count
+        nonlocal retry_needed, bulk_wait_time
+        future, log_number_base = in_flight.popleft()
+        start_time = time.perf_counter()
+        results = future.result()
+        bulk_wait_time += time.perf_counter() - start_time
         # logger.debug(results)
+        adjust_bulk_size(results)
         es_took, success, error, error_reasons, retry = check_es_results(
-            results, total_count)
+            results, log_number_base)
         success_count += success
         error_count += error
         es_response_time += es_took
@@ -378,6 +540,49 @@ def bulkloads_into_opensearch(es_entries, collected_metrics):
             error_reason_list.extend(error_reasons)
         if retry:
             retry_needed = True
+
+    def submit(putdata, offsets):
+        nonlocal sent_count, total_output_size
+        # back-pressure
+        while len(in_flight) >= BULK_CONCURRENCY:
+            collect_oldest_result()
+        total_output_size += len(putdata)
+        in_flight.append(
+            (bulk_executor.submit(send_bulk_request, bytes(putdata), offsets),
+             sent_count))
+        sent_count += len(offsets)
+
+    try:
+        for indexname, docid, parsed_json in es_entries:
+            if AOSS_TYPE == 'TIMESERIES':
+                if docid in docid_set:
+                    continue
+                docid_list.append(docid)
+                action_meta = create_bulk_action(indexname)
+            else:
+                action_meta = create_bulk_action(indexname, docid)
+            # es の http.max_content_length は t2 で10MB なので、追加すると
+            # bulk_size を超える場合は先にESにロードする
+            entry_size = len(action_meta) + len(parsed_json) + 1
+            if offsets and len(putdata) + entry_size > bulk_size:
+                submit(putdata, offsets)
+                putdata = bytearray()
+                offsets = []
+            offsets.append(len(putdata))
+            putdata += action_meta
+            putdata += parsed_json
+            putdata += b'\n'
+        if offsets:
+            submit(putdata, offsets)
+        while in_flight:
+            collect_oldest_result()
+    finally:
+        # do not leave requests of this S3 object for the next invocation
+        for future, log_number_base in in_flight:
+            future.cancel()
+        for future, log_number_base in in_flight:
+            if not future.cancelled():
+                future.exception()
     if AOSS_TYPE == 'TIMESERIES':
         for error_reason in reversed(error_reason_list):
             del docid_list[error_reason['log_number'] - 1]
@@ -387,6 +592,7 @@ def bulkloads_into_opensearch(es_entries, collected_metrics):
     collected_metrics['success_count'] = success_count
     collected_metrics['error_count'] = error_count
     collected_metrics['es_response_time'] = es_response_time
+    collected_metrics['bulk_wait_time'] = bulk_wait_time
 
     return collected_metrics, error_reason_list, retry_needed
 
@@ -404,6 +610,8 @@ def output_metrics(metrics, logfile=None, collected_metrics={}):
     s3_key = logfile.s3key
     duration = int(
         (time.perf_counter() - collected_metrics['start_time']) * 1000) + 10
+    cpu_time = (
+        time.process_time() - collected_metrics['start_cpu_time']) * 1000
     total_log_count = logfile.total_log_count
 
     metrics.add_dimension(name="logtype", value=logfile.logtype)
@@ -429,9 +637,121 @@ def output_metrics(metrics, logfile=None, collected_metrics={}):
         name="TotalLogFileCount", unit=MetricUnit.Count, value=1)
     metrics.add_metric(
         name="TotalLogCount", unit=MetricUnit.Count, value=total_log_count)
+    # e.g. s3_get -> S3GetTime, transform_to_ecs -> TransformToEcsTime
+    stage_elapsed = dict(logfile.stage_elapsed)
+    stage_elapsed['bulk_wait'] = collected_metrics['bulk_wait_time']
+    for stage, elapsed in stage_elapsed.items():
+        name = ''.join(x.capitalize() for x in stage.split('_')) + 'Time'
+        metrics.add_metric(name=name, unit=MetricUnit.Milliseconds,
+                           value=round(elapsed * 1000, 3))
+    if total_log_count:
+        metrics.add_metric(
+            name="CpuTimePerLog", unit=MetricUnit.Milliseconds,
+            value=round(cpu_time / total_log_count, 4))
     metrics.add_metadata(key="s3_key", value=s3_key)
 
 
+def run_init_steps(init_steps):
+    """run independent steps of initialization concurrently.
+
+    init_steps is list of (name, func, timeout, default). 各ステップを
+    スレッドで並列に実行し、timeout (秒) までに終わらなければ default() の
+    値を使う。ステップ毎の所要時間をログに出力する。timeout したステップは
+    バックグラウンドで実行を続け、pending として返す。結果は
+    apply_late_init_results で default と置き換える
+    """
+    results = {}
+    pending = {}
+    elapsed = {}
+    executor = ThreadPoolExecutor(
+        max_workers=len(init_steps), thread_name_prefix='init')
+    start_time = time.perf_counter()
+    futures = [(name, executor.submit(_run_init_step, func), func, timeout,
+                default) for name, func, timeout, default in init_steps]
+    try:
+        for name, future, func, timeout, default in futures:
+            wait = max(start_time + timeout - time.perf_counter(), 0)
+            try:
+                results[name], step_elapsed = future.result(timeout=wait)
+                elapsed[name] = round(step_elapsed * 1000, 1)
+            except TimeoutError:
+                logger.warning(f'{name} did not finish in {timeout} sec. '
+                               'default value is used until it finishes')
+                results[name] = default()
+                pending[name] = (future, func)
+                elapsed[name] = 'timeout'
+    finally:
+        # timed out steps are left running in background
+        executor.shutdown(wait=False)
+    elapsed['total'] = round((time.perf_counter() - start_time) * 1000, 1)
+    logger.info({'init_elapsed_ms': elapsed})
+    return results, pending
+
+
+def _run_init_step(func):
+    step_start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - step_start
+
+
+def set_init_result(name, result):
+    global DOMAIN_INFO, read_only_indices, exclusion_conditions
+    global control_tower_s3_client, security_lake_s3_client
+    global geodb_instance, ioc_instance, xff_instance
+    if name == 'domain_info':
+        DOMAIN_INFO = result
+        logger.info(DOMAIN_INFO)
+    elif name == 'read_only_indices':
+        logger.info(json.dumps({'READ_ONLY_INDICES': result}))
+        read_only_indices = utils.ReadOnlyIndices(
+            result,
+            loader=lambda: utils.get_read_only_indices(
+                es_conn, awsauth, ES_HOSTNAME),
+            ttl=READ_ONLY_INDICES_TTL)
+    elif name == 'exclusion_conditions':
+        exclusion_conditions = result
+        # logconfig has copy of exclusion_conditions
+        create_logconfig.cache_clear()
+    elif name == 'control_tower_s3_client':
+        control_tower_s3_client = result
+    elif name == 'security_lake_s3_client':
+        security_lake_s3_client = result
+    elif name == 'geodb':
+        geodb_instance = result
+    elif name == 'ioc':
+        ioc_instance = result
+    elif name == 'xff':
+        xff_instance = result
+
+
+def apply_late_init_results():
+    """replace default values of timed out init steps with late results.
+
+    ウォームコンテナが default の値 (enrichment 無効など) を使い続けない
+    ように、呼び出し毎に pending のステップを確認する。終わっていれば結果を
+    反映し、例外で終わっていればステップを再実行する
+    """
+    for name, (future, func) in list(init_pending_steps.items()):
+        if not future.done():
+            logger.warning(f'{name} is still running. default value is used')
+            continue
+        try:
+            result, step_elapsed = future.result()
+        except Exception:
+            logger.exception(f'{name} failed in background. retrying')
+            executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='init')
+            init_pending_steps[name] = (
+                executor.submit(_run_init_step, func), func)
+            executor.shutdown(wait=False)
+            continue
+        set_init_result(name, result)
+        del init_pending_steps[name]
+        logger.info(f'{name} finished in background in '
+                    f'{round(step_elapsed * 1000, 1)} ms. default value was '
+                    'replaced')
+
+
 def observability_decorator_switcher(func):
     if os.environ.get('AWS_EXECUTION_ENV'):
         @metrics.log_metrics
@@ -450,21 +770,13 @@ def observability_decorator_switcher(func):
 
 awsauth = utils.create_awsauth(ES_HOSTNAME)
 es_conn = utils.create_es_conn(awsauth, ES_HOSTNAME)
-if SERVICE == 'es':
-    DOMAIN_INFO = es_conn.info()
-    logger.info(DOMAIN_INFO)
-    READ_ONLY_INDICES = utils.get_read_only_indices(
-        es_conn, awsauth, ES_HOSTNAME)
-    logger.info(json.dumps({'READ_ONLY_INDICES': READ_ONLY_INDICES}))
-elif SERVICE == 'aoss':
-    READ_ONLY_INDICES = ''
+es_conn_lock = threading.Lock()
+bulk_executor = ThreadPoolExecutor(
+    max_workers=BULK_CONCURRENCY, thread_name_prefix='bulk')
 user_libs_list = utils.find_user_custom_libs()
 etl_config = utils.get_etl_config()
-utils.load_modules_on_memory(etl_config, user_libs_list)
+# sf_ modules are imported by load_sf_module when the log type is processed
 logtype_s3key_dict = utils.create_logtype_s3key_dict(etl_config)
-if SERVICE == 'es':
-    check_and_create_aliases_if_needed(es_conn)
-exclusion_conditions = utils.get_exclusion_conditions()
 
 builtin_log_exclusion_patterns: dict = (
     utils.make_exclude_own_log_patterns(etl_config))
@@ -473,7 +785,7 @@ custom_log_exclusion_patterns: dict = (
     utils.convert_csv_into_log_patterns(csv_filename))
 log_exclusion_patterns: dict = utils.merge_log_exclusion_patterns(
     builtin_log_exclusion_patterns, custom_log_exclusion_patterns)
-# e.g. log_exclusion_patterns['cloudtrail'] = [pattern1, pattern2]
+# e.g. log_exclusion_patterns['cloudtrail'] = LogExclusionMatcher
 
 s3_session_config = utils.make_s3_session_config(etl_config)
 s3_client = boto3.client('s3', config=s3_session_config)
@@ -485,28 +797,64 @@ control_tower_log_bucket_list = (
 control_tower_role_arn = os.environ.get('CONTROL_TOWER_ROLE_ARN')
 control_tower_role_session_name = os.environ.get(
     'CONTROL_TOWER_ROLE_SESSION_NAME')
-control_tower_s3_client = utils.get_s3_client_for_crosss_account(
-    config=s3_session_config, role_arn=control_tower_role_arn,
-    role_session_name=control_tower_role_session_name)
 
 security_lake_log_buckets = os.environ.get('SECURITY_LAKE_LOG_BUCKETS', '')
 security_lake_role_arn = os.environ.get('SECURITY_LAKE_ROLE_ARN')
 security_lake_role_session_name = os.environ.get(
     'SECURITY_LAKE_ROLE_SESSION_NAME')
 security_lake_external_id = os.environ.get('SECURITY_LAKE_EXTERNAL_ID')
-security_lake_s3_client = utils.get_s3_client_for_crosss_account(
-    config=s3_session_config, role_arn=security_lake_role_arn,
-    role_session_name=security_lake_role_session_name,
-    external_id=security_lake_external_id)
-
-geodb_instance = geodb.GeoDB(s3_session_config)
-ioc_instance = ioc.DB(s3_session_config)
-xff_instance = xff.DB(s3_session_config)
+
+init_steps = []
+if SERVICE == 'es':
+    init_steps += [
+        ('domain_info', es_conn.info, INIT_TIMEOUT_API, dict),
+        ('read_only_indices',
+         lambda: utils.get_read_only_indices(es_conn, awsauth, ES_HOSTNAME),
+         INIT_TIMEOUT_API, tuple),
+        ('aliases', lambda: check_and_create_aliases_if_needed(es_conn),
+         INIT_TIMEOUT_API, lambda: None),
+    ]
+init_steps += [
+    ('exclusion_conditions', utils.get_exclusion_conditions,
+     INIT_TIMEOUT_API, dict),
+    ('control_tower_s3_client',
+     lambda: utils.get_s3_client_for_crosss_account(
+         config=s3_session_config, role_arn=control_tower_role_arn,
+         role_session_name=control_tower_role_session_name),
+     INIT_TIMEOUT_API, lambda: None),
+    ('security_lake_s3_client',
+     lambda: utils.get_s3_client_for_crosss_account(
+         config=s3_session_config, role_arn=security_lake_role_arn,
+         role_session_name=security_lake_role_session_name,
+         external_id=security_lake_external_id),
+     INIT_TIMEOUT_API, lambda: None),
+    ('geodb', lambda: geodb.GeoDB(s3_session_config), INIT_TIMEOUT_DOWNLOAD,
+     lambda: geodb.GeoDB(s3_session_config, enabled=False)),
+    ('ioc', lambda: ioc.DB(s3_session_config), INIT_TIMEOUT_DOWNLOAD,
+     lambda: ioc.DB(s3_session_config, enabled=False)),
+    ('xff', lambda: xff.DB(s3_session_config), INIT_TIMEOUT_DOWNLOAD,
+     lambda: xff.DB(s3_session_config, enabled=False)),
+]
+init_results, init_pending_steps = run_init_steps(init_steps)
+if SERVICE == 'aoss':
+    read_only_indices = utils.ReadOnlyIndices()
+for name, result in init_results.items():
+    set_init_result(name, result)
+del init_steps, init_results
 utils.show_local_dir()
 
 
 @observability_decorator_switcher
 def lambda_handler(event, context):
+    global lambda_deadline
+    if hasattr(context, 'get_remaining_time_in_millis'):
+        lambda_deadline = (
+            time.monotonic() + context.get_remaining_time_in_millis() / 1000)
+    else:
+        # local execution passes dict as context. no deadline
+        lambda_deadline = None
+    if init_pending_steps:
+        apply_late_init_results()
     batch_item_failures = main(event, context)
     if batch_item_failures:
         return {"batchItemFailures": batch_item_failures}
@@ -562,7 +910,8 @@ def main(event, context):
 
 
 def process_record(record):
-    collected_metrics = {'start_time': time.perf_counter()}
+    collected_metrics = {'start_time': time.perf_counter(),
+                         'start_cpu_time': time.process_time()}
     # S3からファイルを取得してログを抽出する
     logfile = extract_logfile_from_s3(record)
     if logfile is None:
@@ -582,6 +931,9 @@ def process_record(record):
     # 作成したデータをESにPUTしてメトリクスを収集する
     (collected_metrics, error_reason_list, retry_needed) = (
         bulkloads_into_opensearch(es_entries, collected_metrics))
+    if not retry_needed:
+        # 最初のピースのロード後に送るので、リトライで二重に送られない
+        logfile.send_split_pieces()
     output_metrics(metrics, logfile=logfile,
                    collected_metrics=collected_metrics)
     if logfile.error_logs_count > 0:
@@ -9,31 +9,48 @@ __url__ = 'https://github.com/aws-samples/siem-on-amazon-opensearch-service'
 
 import bz2
 import copy
+import csv
 import gzip
 import hashlib
+import importlib
 import io
 import json
 import re
+import tempfile
+import time
 import zipfile
+from collections import defaultdict
 from datetime import datetime, timedelta, timezone
 from functools import cached_property
+from itertools import islice
 from typing import Tuple
 
 from aws_lambda_powertools import Logger
 
 from siem import user_agent, utils
 from siem.fileformat_base import FileFormatBase
-from siem.fileformat_cef import FileFormatCef
-from siem.fileformat_csv import FileFormatCsv
-from siem.fileformat_json import FileFormatJson
-from siem.fileformat_multiline import FileFormatMultiline
-from siem.fileformat_parquet import FileFormatParquet
-from siem.fileformat_text import FileFormatText
-from siem.fileformat_winevtxml import FileFormatWinEvtXml
-from siem.fileformat_xml import FileFormatXml
+from siem.s3stream import open_s3_stream
 
 logger = Logger(child=True)
 
+# file format classes are imported when the file format is used for the first
+# time to reduce cold start time. ファイルフォーマット毎に初回だけ import する
+FILE_FORMAT_CLASSES = {
+    'text': ('siem.fileformat_text', 'FileFormatText'),
+    'json': ('siem.fileformat_json', 'FileFormatJson'),
+    'csv': ('siem.fileformat_csv', 'FileFormatCsv'),
+    'winevtxml': ('siem.fileformat_winevtxml', 'FileFormatWinEvtXml'),
+    'multiline': ('siem.fileformat_multiline', 'FileFormatMultiline'),
+    'parquet': ('siem.fileformat_parquet', 'FileFormatParquet'),
+    'xml': ('siem.fileformat_xml', 'FileFormatXml'),
+    'cef': ('siem.fileformat_cef', 'FileFormatCef'),
+}
+
+
+def get_file_format_class(file_format):
+    module_name, class_name = FILE_FORMAT_CLASSES[file_format]
+    return getattr(importlib.import_module(module_name), class_name)
+
 
 class LogS3:
     """取得した一連のログファイルから表層的な情報を取得し、個々のログを返す.
@@ -41,6 +58,9 @@ class LogS3:
     圧縮の有無の判断、ログ種類を判断、フォーマットの判断をして
     最後に、生ファイルを個々のログに分割してリスト型として返す
     """
+    CWL_READ_SIZE = 1048576
+    SLICE_READ_SIZE = 1048576
+
     def __init__(self, record, s3bucket, s3key, logtype, logconfig, s3_client,
                  sqs_queue):
         self.error_logs_count = 0
@@ -54,6 +74,13 @@ class LogS3:
         self.s3obj_size = self.s3obj_size
         self.excluded_log_count = 0
         self.counted_log_count = 0
+        # (metadata, offsets) of pieces which are sent to SQS after the first
+        # piece is loaded
+        self.split_pieces = None
+        self.__piece_positions = None
+        self.__rawdata_size = 0
+        # accumulated seconds of each stage of LogS3 and LogParser
+        self.stage_elapsed = defaultdict(float)
 
         self.loggroup = None
         self.logstream = None
@@ -65,25 +92,39 @@ class LogS3:
         self.via_firelens = self.logconfig['via_firelens']
         self.file_format = self.logconfig['file_format']
         self.max_log_count = self.logconfig['max_log_count']
+        start_time = time.perf_counter()
         self.__rawdata = self.extract_rawdata_from_s3obj()
+        self.stage_elapsed['s3_get'] += time.perf_counter() - start_time
         if self.__rawdata:
             self.__file_timestamp = self.extract_file_timestamp()
             self.rawfile_instacne = self.set_rawfile_instance()
+            if self.end_offset:
+                self.__rawdata = self.slice_rawdata()
 
     def __iter__(self):
         if self.is_ignored:
             return
-        if self.log_count > self.max_log_count:
-            if self.sqs_queue:
-                metadata = self.split_logs(self.log_count, self.max_log_count)
-                sent_count = self.send_meta_to_sqs(metadata)
-                self.is_ignored = True
-                self.total_log_count = 0
-                self.ignored_reason = (f'Log file was split into {sent_count}'
-                                       f' pieces and sent to SQS.')
-                return
-
         yield from self.logdata_generator()
+        if self.end_number != 0:
+            return
+
+        # logs are counted while they are extracted, so the S3 object is
+        # parsed only once. All logs are counted again only when the number
+        # of extracted logs reaches max_log_count.
+        if self.total_log_count == 0:
+            self.is_ignored = True
+            self.ignored_reason = 'there are not any valid logs in S3 object'
+        elif (self.total_log_count >= self.max_log_count_in_first_piece
+                and self.line_count > self.max_log_count
+                and self.sqs_queue):
+            # the first piece has been already extracted. the rest of pieces
+            # are sent by send_split_pieces after the first piece is loaded
+            start_time = time.perf_counter()
+            metadata = self.split_logs(
+                self.line_count, self.max_log_count)[1:]
+            offsets = self.get_offsets_of_pieces(metadata)
+            self.split_pieces = (metadata, offsets)
+            self.stage_elapsed['split'] += time.perf_counter() - start_time
 
     ###########################################################################
     # Property
@@ -125,10 +166,11 @@ class LogS3:
         if self.end_number == 0:
             if self.via_cwl:
                 log_count = self.log_count_cwl_log()
-            elif self.via_firelens:
-                log_count = len(self.rawdata.readlines())
+            elif self.via_firelens or self.file_format in (
+                    'text', 'cef', 'multiline', 'csv'):
+                log_count = self.count_logs_and_offsets()
             else:
-                # text, json, csv, winevtxml, multiline, xml, parquet
+                # json, winevtxml, xml, parquet
                 log_count = self.rawfile_instacne.log_count
             if log_count == 0:
                 self.is_ignored = True
@@ -138,11 +180,28 @@ class LogS3:
         else:
             return (self.end_number - self.start_number + 1)
 
+    @property
+    def line_count(self):
+        # pieces are numbered by lines including the header. log_count of CSV
+        # excludes the header, so it is added back unless records have
+        # multiple lines. is_multiline is detected while logs are counted
+        log_count = self.log_count
+        if (self.file_format == 'csv' and not self.via_firelens
+                and not getattr(self.rawfile_instacne, 'is_multiline', True)):
+            return log_count + self.rawfile_instacne.ignore_header_line_number
+        return log_count
+
     @property
     def rawdata(self):
         self.__rawdata.seek(0)
         return self.__rawdata
 
+    @property
+    def is_raw_log_prefiltered(self):
+        # raw exclusion patterns are already evaluated before parsing
+        return (self.via_cwl or self.via_firelens
+                or self.rawfile_instacne.prefilters_raw_log)
+
     @cached_property
     def accountid(self):
         s3key_accountid = utils.extract_aws_account_from_text(self.s3key)
@@ -173,6 +232,34 @@ class LogS3:
         except KeyError:
             return 0
 
+    @cached_property
+    def start_offset(self):
+        try:
+            return int(self.record['siem']['start_offset'])
+        except KeyError:
+            return 0
+
+    @cached_property
+    def end_offset(self):
+        try:
+            return int(self.record['siem']['end_offset'])
+        except KeyError:
+            return 0
+
+    @property
+    def is_offset_available(self):
+        # 1 行 (multiline は先頭行) 単位で分割できるログのみ、
+        # 解凍後のバイトオフセットで分割範囲を指定できる
+        if self.via_cwl:
+            return False
+        elif self.via_firelens:
+            return True
+        elif self.file_format in ('text', 'cef', 'multiline'):
+            return True
+        elif self.file_format == 'csv':
+            return not getattr(self.rawfile_instacne, 'is_multiline', True)
+        return False
+
     @cached_property
     def s3obj_size(self):
         if 's3' in self.record:
@@ -189,28 +276,16 @@ class LogS3:
                     's3_key': self.s3key, 'logtype': self.logtype,
                     'start_number': self.start_number,
                     'end_number': self.end_number}
+        if self.end_offset:
+            startmsg['start_offset'] = self.start_offset
+            startmsg['end_offset'] = self.end_offset
         return startmsg
 
     def set_rawfile_instance(self):
-        if self.file_format == 'text':
-            return FileFormatText(self.rawdata, self.logconfig, self.logtype)
-        elif self.file_format == 'json':
-            return FileFormatJson(self.rawdata, self.logconfig, self.logtype)
-        elif self.file_format == 'csv':
-            return FileFormatCsv(self.rawdata, self.logconfig, self.logtype)
-        elif self.file_format == 'winevtxml':
-            return FileFormatWinEvtXml(
+        if self.file_format in FILE_FORMAT_CLASSES:
+            file_format_class = get_file_format_class(self.file_format)
+            return file_format_class(
                 self.rawdata, self.logconfig, self.logtype)
-        elif self.file_format == 'multiline':
-            return FileFormatMultiline(
-                self.rawdata, self.logconfig, self.logtype)
-        elif self.file_format == 'parquet':
-            return FileFormatParquet(
-                self.rawdata, self.logconfig, self.logtype)
-        elif self.file_format == 'xml':
-            return FileFormatXml(self.rawdata, self.logconfig, self.logtype)
-        elif self.file_format == 'cef':
-            return FileFormatCef(self.rawdata, self.logconfig, self.logtype)
         elif not self.file_format:
             self.is_ignored = True
             self.ignored_reason = (
@@ -223,19 +298,33 @@ class LogS3:
         logmeta = {}
         if self.__file_timestamp:
             logmeta['file_timestamp'] = self.__file_timestamp
-        start, end = self.set_start_end_position()
-        self.total_log_count = end - start + 1
+        if self.end_number == 0:
+            start = self.rawfile_instacne.ignore_header_line_number + 1
+            end = self.max_log_count
+            self.max_log_count_in_first_piece = end - start + 1
+        else:
+            start, end = self.set_start_end_position()
+        self.total_log_count = 0
+        if (self.end_number == 0 and self.file_format == 'csv'
+                and not self.via_firelens
+                and self.rawfile_instacne.csv_delimiter):
+            # CSV needs to be counted to know whether a record has multiple
+            # lines. offsets of pieces are recorded in the same pass
+            if self.log_count == 0:
+                return
 
         if self.via_cwl:
-            for lograw, logmeta in self.extract_cwl_log(start, end, logmeta):
-                logdict = self.rawfile_instacne.convert_lograw_to_dict(lograw)
+            for lograw, logmeta in self._count_logs(
+                    self.extract_cwl_log(start, end, logmeta)):
+                logdict = self.rawfile_instacne.exclude_or_convert_lograw(
+                    lograw)
                 if isinstance(logdict, dict):
                     yield (lograw, logdict, logmeta)
                 elif logdict == 'regex_error':
                     self.error_logs_count += 1
         elif self.via_firelens:
-            for lograw, logdict, logmeta in self.extract_firelens_log(
-                    start, end, logmeta):
+            for lograw, logdict, logmeta in self._count_logs(
+                    self.extract_firelens_log(start, end, logmeta)):
                 if logmeta.get('is_ignored'):
                     yield (lograw, {}, logmeta)
                 elif logmeta.get('__skip_normalization'):
@@ -244,7 +333,20 @@ class LogS3:
                     yield (lograw, logdict, logmeta)
         else:
             # json, text, csv, multiline, xml, winevtxml, parquet
-            yield from self.rawfile_instacne.extract_log(start, end, logmeta)
+            yield from self._count_logs(
+                self.rawfile_instacne.extract_log(start, end, logmeta))
+
+    def _count_logs(self, logs):
+        stage_elapsed = self.stage_elapsed
+        logs = iter(logs)
+        while True:
+            start_time = time.perf_counter()
+            log = next(logs, None)
+            stage_elapsed['extract'] += time.perf_counter() - start_time
+            if log is None:
+                return
+            self.total_log_count += 1
+            yield log
 
     def set_start_end_position(self, ignore_header_line_number=None):
         if not ignore_header_line_number:
@@ -253,7 +355,11 @@ class LogS3:
             ignore_header_line_number = (
                 self.rawfile_instacne.ignore_header_line_number)
 
-        if self.start_number <= ignore_header_line_number:
+        if self.end_offset:
+            # rawdata is already narrowed down to the piece with header
+            start = ignore_header_line_number + 1
+            end = ignore_header_line_number + self.log_count
+        elif self.start_number <= ignore_header_line_number:
             start = ignore_header_line_number + 1
             if self.max_log_count >= self.log_count:
                 end = self.log_count
@@ -264,6 +370,120 @@ class LogS3:
             end = self.end_number
         return start, end
 
+    def slice_rawdata(self):
+        """narrow down rawdata to the piece of logs by byte offsets.
+
+        非圧縮ファイルは Range 指定の GetObject でその範囲だけを読み込む。
+        圧縮ファイルは解凍しながら読み飛ばすので、ログのパースは不要となる。
+        rawdata は何度も先頭に戻して読むので、範囲は 1 度だけ読み込んで
+        メモリ (大きい場合は一時ファイル) に保持し、再度解凍しない
+        """
+        self.__rawdata.seek(0)
+        binary = self.__rawdata.detach()
+        piece_size = self.end_offset - self.start_offset
+        if piece_size > self.logconfig['s3_streaming_threshold']:
+            piece = tempfile.TemporaryFile()
+        else:
+            piece = io.BytesIO()
+        for x in range(self.rawfile_instacne.ignore_header_line_number):
+            piece.write(binary.readline())
+        binary.seek(self.start_offset)
+        while piece_size > 0:
+            data = binary.read(min(piece_size, self.SLICE_READ_SIZE))
+            if not data:
+                break
+            piece.write(data)
+            piece_size -= len(data)
+        binary.close()
+        piece.seek(0)
+        rawdata = io.TextIOWrapper(piece, encoding='utf8', errors='ignore')
+        self.rawfile_instacne.rawdata = rawdata
+        return rawdata
+
+    def count_logs_and_offsets(self):
+        """count logs and record byte offsets of pieces in one pass.
+
+        ログを数えながら、max_log_count 件毎の分割位置となるログの解凍後の
+        バイトオフセットを記録するので、分割時にファイルを読み直さない。
+        CSV は同じパスで行数とレコード数を数えて複数行のレコードを判定する。
+        改行コードが CR だけの行がある場合は、行とオフセットが対応しないので
+        オフセットを記録せずに数え直す
+        """
+        rawfile = self.rawfile_instacne
+        if self.file_format == 'multiline' and not self.via_firelens:
+            match_firstline = rawfile._match_multiline_firstline
+        else:
+            match_firstline = None
+        if self.file_format == 'csv' and not self.via_firelens:
+            csv_delimiter = rawfile.csv_delimiter
+        else:
+            csv_delimiter = None
+        piece_size = self.max_log_count
+        positions = {}
+        number: int = 0
+        offset: int = 0
+        has_cr = False
+
+        def scan_lines():
+            nonlocal number, offset, has_cr
+            for line in self.rawdata.buffer:
+                if line.endswith(b'\r\n'):
+                    line_body = line[:-2]
+                else:
+                    line_body = line.rstrip(b'\n')
+                if b'\r' in line_body:
+                    # TextIOWrapper regards CR as end of line
+                    has_cr = True
+                    return
+                if match_firstline:
+                    if match_firstline(line.decode('utf8', errors='ignore')):
+                        number += 1
+                        if (number - 1) % piece_size == 0:
+                            positions[number] = offset
+                else:
+                    number += 1
+                    if (number - 1) % piece_size == 0:
+                        positions[number] = offset
+                offset += len(line)
+                yield line
+
+        if csv_delimiter:
+            lines = (x.decode('utf8', errors='ignore') for x in scan_lines())
+            row_count = sum(
+                1 for row in csv.reader(lines, delimiter=csv_delimiter))
+        else:
+            for line in scan_lines():
+                pass
+            row_count = number
+        self.rawdata.seek(0)
+        if has_cr:
+            if self.via_firelens:
+                return sum(1 for line in self.rawdata)
+            return rawfile.log_count
+        self.__piece_positions = positions
+        self.__rawdata_size = offset
+        if csv_delimiter is not None:
+            # same as FileFormatCsv.log_count
+            rawfile.is_multiline = (number != row_count)
+            rawfile.log_count = row_count - rawfile.ignore_header_line_number
+            return rawfile.log_count
+        return number
+
+    def get_offsets_of_pieces(self, metadata):
+        """return byte offsets of each piece in decompressed S3 object.
+
+        split された各ログの先頭と末尾のバイトオフセットを、
+        count_logs_and_offsets で記録した位置から返す。
+        記録されていない場合は None を返す
+        """
+        if not self.is_offset_available or not self.__piece_positions:
+            return None
+        positions = self.__piece_positions
+        if not all(start in positions for start, end in metadata):
+            return None
+        return [(positions[start], positions.get(end + 1, self.__rawdata_size))
+                for start, end in metadata]
+
     def extract_file_timestamp(self):
         re_file_timestamp_format = self.logconfig['file_timestamp_format']
         if re_file_timestamp_format:
@@ -287,62 +507,80 @@ class LogS3:
         else:
             return None
 
-    def log_count_cwl_log(self):
-        idx: int = 0
-        line_num: int = 0
+    def _iter_cwl_data_messages(self):
+        """yield DATA_MESSAGE of CloudWatch Logs subscription.
+
+        Concatenated JSON objects are decoded in chunks so that the whole
+        body is never loaded into memory.
+        """
         decoder = json.JSONDecoder()
-        body: str = self.__rawdata.read()
-        body_size: int = len(body)
         _w = json.decoder.WHITESPACE.match
+        rawdata = self.rawdata
+        read_size = self.CWL_READ_SIZE
+        body: str = ''
+        is_eof = False
+
+        while not is_eof:
+            chunk = rawdata.read(read_size)
+            if chunk:
+                body += chunk
+            else:
+                is_eof = True
+            idx: int = 0
+            body_size: int = len(body)
+            while True:
+                # skip leading whitespace
+                idx = _w(body, idx).end()
+                if idx >= body_size:
+                    break
+                try:
+                    obj, idx_end = decoder.raw_decode(body, idx=idx)
+                except json.JSONDecodeError:
+                    if is_eof:
+                        raise
+                    # incomplete object. read more data
+                    read_size *= 2
+                    break
+                idx = idx_end
+                read_size = self.CWL_READ_SIZE
+                if (isinstance(obj, dict)
+                        and 'logEvents' in obj
+                        and obj['messageType'] == 'DATA_MESSAGE'):
+                    yield obj
+            body = body[idx:]
 
-        while True:
-            # skip leading whitespace
-            idx = _w(body, idx).end()
-            if idx >= body_size:
-                break
-            obj, idx = decoder.raw_decode(body, idx=idx)
-            if (isinstance(obj, dict)
-                    and 'logEvents' in obj
-                    and obj['messageType'] == 'DATA_MESSAGE'):
-                line_num += len(obj['logEvents'])
+    def log_count_cwl_log(self):
+        line_num: int = 0
+        for obj in self._iter_cwl_data_messages():
+            line_num += len(obj['logEvents'])
 
         return line_num
 
     def extract_cwl_log(self, start, end, logmeta={}):
-        idx: int = 0
         line_num: int = 0
-        decoder = json.JSONDecoder()
-        self.__rawdata.seek(0)
-        body: str = self.__rawdata.read()
-        body_size: int = len(body)
-        _w = json.decoder.WHITESPACE.match
-
-        while True:
-            # skip leading whitespace
-            idx = _w(body, idx).end()
-            if idx >= body_size:
+        for obj in self._iter_cwl_data_messages():
+            if line_num + len(obj['logEvents']) < start:
+                line_num += len(obj['logEvents'])
+                continue
+            cwl_logmeta = copy.copy(logmeta)
+            cwl_logmeta['cwl_accountid'] = obj['owner']
+            cwl_logmeta['loggroup'] = obj['logGroup']
+            cwl_logmeta['logstream'] = obj['logStream']
+            for logevent in obj['logEvents']:
+                line_num += 1
+                if start <= line_num <= end:
+                    cwl_logmeta['cwl_id'] = logevent['id']
+                    cwl_logmeta['cwl_timestamp'] = logevent['timestamp']
+                    yield (logevent['message'], cwl_logmeta)
+            if line_num >= end:
                 break
-            obj, idx = decoder.raw_decode(body, idx=idx)
-            if (isinstance(obj, dict)
-                    and 'logEvents' in obj
-                    and obj['messageType'] == 'DATA_MESSAGE'):
-                cwl_logmeta = copy.copy(logmeta)
-                cwl_logmeta['cwl_accountid'] = obj['owner']
-                cwl_logmeta['loggroup'] = obj['logGroup']
-                cwl_logmeta['logstream'] = obj['logStream']
-                for logevent in obj['logEvents']:
-                    line_num += 1
-                    if start <= line_num <= end:
-                        cwl_logmeta['cwl_id'] = logevent['id']
-                        cwl_logmeta['cwl_timestamp'] = logevent['timestamp']
-                        yield (logevent['message'], cwl_logmeta)
 
     def extract_firelens_log(self, start, end, logmeta={}):
         ignore_container_stderr_bool = (
             self.logconfig['ignore_container_stderr'])
         start_index = start - 1
         end_index = end
-        for logdata in self.rawdata.readlines()[start_index:end_index]:
+        for logdata in islice(self.rawdata, start_index, end_index):
             obj = json.loads(logdata.strip())
             logdict = {}
             firelens_logmeta = copy.copy(logmeta)
@@ -370,7 +608,7 @@ class LogS3:
 
             try:
                 logdict = (
-                    self.rawfile_instacne.convert_lograw_to_dict(logdata))
+                    self.rawfile_instacne.exclude_or_convert_lograw(logdata))
                 if (logdict == 'regex_error'
                         and firelens_logmeta['container_source'] == 'stderr'):
                     raise Exception('regex_error')
@@ -400,13 +638,23 @@ class LogS3:
             self.ignored_reason = (f'no valid contents in s3 object, size of '
                                    f'{self.s3key} is only {s3size} byte')
             return None
-        rawbody = io.BytesIO(obj['Body'].read())
+        if (s3size > self.logconfig['s3_streaming_threshold']
+                or self.end_offset):
+            # big object is decompressed and read in chunks
+            logger.info(f'streaming mode is enabled for {s3size} bytes object')
+            rawbody = open_s3_stream(
+                self.s3_client, self.s3bucket, self.s3key, s3size, obj)
+        else:
+            rawbody = io.BytesIO(obj['Body'].read())
         # confirmd and ignored Rule-884405
         mime_type = utils.get_mime_type(rawbody.read(16))
         rawbody.seek(0)
         if mime_type == 'text':
             body = io.TextIOWrapper(rawbody, encoding='utf8', errors='ignore')
         elif mime_type == 'parquet':
+            if not isinstance(rawbody, io.BytesIO):
+                # parquet needs random access to the footer
+                rawbody = io.BytesIO(rawbody.read())
             body = rawbody
             # confirmd and ignored Rule-884405
             self.file_format = 'parquet'
@@ -461,7 +709,23 @@ class LogS3:
             splite_logs_list.append((start, end))
         return splite_logs_list
 
-    def send_meta_to_sqs(self, metadata):
+    def send_split_pieces(self):
+        """send the rest of pieces to SQS after the first piece is loaded.
+
+        最初のピースがリトライされた場合に、同じピースが二重に送られて
+        ロードされないように、ロードの成功後に呼ぶ
+        """
+        if not self.split_pieces:
+            return
+        start_time = time.perf_counter()
+        metadata, offsets = self.split_pieces
+        self.split_pieces = None
+        sent_count = self.send_meta_to_sqs(metadata, offsets)
+        self.stage_elapsed['split'] += time.perf_counter() - start_time
+        logger.info(f'The rest of log file was split into {sent_count} '
+                    'pieces and sent to SQS.')
+
+    def send_meta_to_sqs(self, metadata, offsets=None):
         logger.debug({'split_logs': f's3://{self.s3bucket}/{self.s3key}',
                       'max_log_count': self.max_log_count,
                       'log_count': self.log_count})
@@ -472,6 +736,9 @@ class LogS3:
                 "siem": {"start_number": start, "end_number": end},
                 "s3": {"bucket": {"name": self.s3bucket},
                        "object": {"key": self.s3key}}}
+            if offsets:
+                queue_body['siem']['start_offset'] = offsets[i][0]
+                queue_body['siem']['end_offset'] = offsets[i][1]
             message_body = json.dumps(queue_body)
             entries.append({'Id': f'num_{start}', 'MessageBody': message_body})
             if (len(entries) == 10) or (i == last_num - 1):
@@ -515,8 +782,15 @@ class LogParser:
             self.index_tz = timezone(
                 timedelta(hours=float(self.logconfig['index_tz'])))
         self.has_nanotime = self.logconfig['timestamp_nano']
+        # remembers the format which matched last
+        self.timestamp_parser = utils.TimestampParser(
+            self.logconfig['timestamp_format_list']
+            or [self.logconfig['timestamp_format']])
+        self.exclusion_patterns = self.logconfig.get('exclusion_patterns')
+        self.is_raw_log_prefiltered = logfile.is_raw_log_prefiltered
 
     def __call__(self, lograw, logdict, logmeta):
+        self.__excluded_reason = None
         if isinstance(logdict, dict):
             pass
         elif logdict == 'regex_error':
@@ -549,8 +823,12 @@ class LogParser:
             self.__logdata_dict = dict(self.__logdata_dict, **logmeta)
             if 'file_timestamp' in self.__logdata_dict:
                 del self.__logdata_dict['file_timestamp']
+        # 正規化やエンリッチの前に、元のログのフィールドで除外する
+        self.exclude_logs_by_patterns()
         if self.is_ignored:
             return
+        stage_elapsed = self.logfile.stage_elapsed
+        time1 = time.perf_counter()
         self.__event_ingested = datetime.now(timezone.utc)
         self.__skip_normalization = self.set_skip_normalization()
 
@@ -562,16 +840,26 @@ class LogParser:
         # 同じフィールド名で複数タイプがあるとESにロードするとエラーになるので
         # 該当フィールドだけテキスト化する
         self.clean_multi_type_field()
+        time2 = time.perf_counter()
         # フィールドをECSにマッピングして正規化する
         self.transform_to_ecs()
+        time3 = time.perf_counter()
         # 一部のフィールドを修正する
         self.transform_by_script()
+        time4 = time.perf_counter()
         # ログにgeoipなどの情報をエンリッチ
         self.enrich()
+        time5 = time.perf_counter()
         # add filed prefix to original log
         self.add_field_prefix()
         # exclude logs by conditional expressions in Parameter Store
         self.exclude_logs_by_conditions()
+        time6 = time.perf_counter()
+        stage_elapsed['normalize'] += time2 - time1
+        stage_elapsed['transform_to_ecs'] += time3 - time2
+        stage_elapsed['transform_by_script'] += time4 - time3
+        stage_elapsed['enrich'] += time5 - time4
+        stage_elapsed['exclude'] += time6 - time5
 
     ###########################################################################
     # Property
@@ -581,15 +869,9 @@ class LogParser:
         if self.__logdata_dict.get('is_ignored'):
             self.ignored_reason = self.__logdata_dict.get('ignored_reason')
             return True
-        elif 'exclusion_patterns' in self.logconfig:
-            for pattern in self.logconfig['exclusion_patterns']:
-                is_excluded, ex_pattern = (
-                    utils.match_log_with_exclude_patterns(
-                        self.__logdata_dict, pattern))
-                if is_excluded:
-                    self.ignored_reason = (
-                        f'matched {ex_pattern} with log_exclusion_patterns')
-                    return True
+        elif self.__excluded_reason:
+            self.ignored_reason = self.__excluded_reason
+            return True
         return False
 
     @property
@@ -657,13 +939,26 @@ class LogParser:
 
     @property
     def json(self):
-        # 内部で管理用のフィールドを削除
-        self.__logdata_dict = self.del_none(self.__logdata_dict)
-        loaded_data = json.dumps(self.__logdata_dict, cls=utils.MyEncoder)
-        # サイズが Lucene の最大値である 32766 Byte を超えてるかチェック
-        if len(loaded_data) >= 65536:
-            self.__logdata_dict = self.truncate_big_field(self.__logdata_dict)
-            loaded_data = json.dumps(self.__logdata_dict, cls=utils.MyEncoder)
+        """return the log as JSON bytes"""
+        start_time = time.perf_counter()
+        # 値のないフィールドを削除し、大きな文字列のフィールドを集める
+        big_fields = []
+        self.prune_fields(self.__logdata_dict, big_fields)
+        # ドキュメントが 65536 Byte 以上の時だけ、Lucene の最大値である
+        # 32766 Byte を超えるフィールドを切り捨てる
+        big_fields = [
+            (d, key, len(d[key].encode('utf-8', 'surrogatepass')))
+            for d, key in big_fields]
+        if sum(x[2] for x in big_fields) >= 65536:
+            # the document is obviously bigger than 65536 bytes
+            self.truncate_big_fields(big_fields)
+            loaded_data = utils.json_dumps(self.__logdata_dict)
+        else:
+            loaded_data = utils.json_dumps(self.__logdata_dict)
+            if (len(loaded_data) >= 65536
+                    and self.truncate_big_fields(big_fields)):
+                loaded_data = utils.json_dumps(self.__logdata_dict)
+        self.logfile.stage_elapsed['json'] += time.perf_counter() - start_time
         return loaded_data
 
     ###########################################################################
@@ -743,37 +1038,11 @@ class LogParser:
             self.__logdata_dict, clean_multi_type_dict)
 
     def get_value_and_input_into_ecs_dict(self, ecs_dict):
-        new_ecs_dict = {}
-        ecs_keys = self.logconfig['ecs']
-        for ecs_key in ecs_keys:
-            original_keys = self.logconfig[ecs_key]
-            if isinstance(original_keys, str):
-                v = utils.value_from_nesteddict_by_dottedkeylist(
-                    self.__logdata_dict, original_keys)
-                if isinstance(v, str):
-                    v = utils.validate_ip(v, ecs_key)
-                if v == 0 or v:
-                    new_ecs_dict = utils.put_value_into_nesteddict(ecs_key, v)
-            elif isinstance(original_keys, list):
-                temp_list = []
-                for original_key_list in original_keys:
-                    v = utils.value_from_nesteddict_by_dottedkeylist(
-                        self.__logdata_dict, original_key_list)
-                    if isinstance(v, str):
-                        v = utils.validate_ip(v, ecs_key)
-                        if v:
-                            temp_list.append(v)
-                    elif isinstance(v, list):
-                        for i in v:
-                            each_v = utils.validate_ip(i, ecs_key)
-                            if each_v:
-                                temp_list.append(each_v)
-                if temp_list:
-                    new_ecs_dict = utils.put_value_into_nesteddict(
-                        ecs_key, sorted(list(set(temp_list))))
-            if new_ecs_dict:
-                new_ecs_dict = utils.merge_dicts(ecs_dict, new_ecs_dict)
-        return ecs_dict
+        ecs_mapping_plan = self.logconfig.get('ecs_mapping_plan')
+        if ecs_mapping_plan is None:
+            ecs_mapping_plan = utils.EcsMappingPlan(self.logconfig)
+            self.logconfig['ecs_mapping_plan'] = ecs_mapping_plan
+        return ecs_mapping_plan.apply(self.__logdata_dict, ecs_dict)
 
     def transform_to_ecs(self):
         cloud = self.__logdata_dict.get('cloud', {})
@@ -992,6 +1261,22 @@ class LogParser:
                 except KeyError:
                     pass
 
+    def exclude_logs_by_patterns(self):
+        """exclude log by log_exclusion_patterns of original fields.
+
+        除外パターンは元のログのフィールド名で指定されるので、
+        convert_lograw_to_dict の直後に一度だけ評価する
+        """
+        if not self.exclusion_patterns:
+            return
+        matched = None
+        if not self.is_raw_log_prefiltered:
+            matched = self.exclusion_patterns.match_raw(self.lograw)
+        if not matched and self.exclusion_patterns.has_field_patterns:
+            matched = self.exclusion_patterns.match(self.__logdata_dict)
+        if matched:
+            self.__excluded_reason = f'matched {matched}'
+
     def exclude_logs_by_conditions(self):
         if 'exclusion_conditions' not in self.logconfig:
             return
@@ -1001,10 +1286,10 @@ class LogParser:
         for condition in exclusion_conditions:
             action = condition['action'].lower()
             expression = condition['expression']
-            compiled_expression = condition['compiled_expression']
+            predicate = condition['predicate']
             condition_name = condition['name']
             try:
-                is_excluded = compiled_expression.search(record)
+                is_excluded = predicate(record)
             except Exception:
                 msg = f"Failed to query JMESPath with '{condition_name}'"
                 logger.exception(msg)
@@ -1050,10 +1335,6 @@ class LogParser:
             else:
                 timestamp_key_list = [self.logconfig['timestamp_key'], ]
 
-            timestamp_format_list = self.logconfig['timestamp_format_list']
-            if not timestamp_format_list:
-                timestamp_format_list = [self.logconfig['timestamp_format']]
-
             for timestamp_key in timestamp_key_list:
                 if timestamp_key == 'cwe_timestamp':
                     self.__logdata_dict['cwe_timestamp'] = self.cwe_timestamp
@@ -1070,9 +1351,7 @@ class LogParser:
                 msg = f'there is no valid timestamp_key for {self.logtype}'
                 logger.error(msg)
                 raise ValueError(msg)
-            dt = utils.convert_timestr_to_datetime_wrapper(
-                timestr, timestamp_key, timestamp_format_list,
-                self.timestamp_tz)
+            dt = self.timestamp_parser(timestr, self.timestamp_tz)
             if dt is None or dt == '':
                 msg = f'there is no timestamp format for {self.logtype}'
                 logger.error(msg)
@@ -1100,49 +1379,62 @@ class LogParser:
             raise ValueError(msg)
         return dt
 
-    def del_none(self, d):
-        """値のないキーを削除する。削除しないとESへのLoad時にエラーとなる """
-        for key, value in list(d.items()):
-            if isinstance(value, list):
+    def prune_fields(self, d, big_fields, is_in_list=False):
+        """値のないキーを削除する。削除しないとESへのLoad時にエラーとなる
+
+        同じ走査で、切り捨ての対象になりうる 16383 文字以上の文字列の
+        フィールドを (dict, key) で big_fields に集める。リストの中の dict は
+        値のないキーの削除だけを行う
+        """
+        empty_keys = []
+        for key, value in d.items():
+            if isinstance(value, str):
+                if value in ('', '-', 'null', '[]'):
+                    empty_keys.append(key)
+                elif (len(value) >= 16383 and not is_in_list
+                        and key not in ("@message", )):
+                    big_fields.append((d, key))
+            elif value is None:
+                empty_keys.append(key)
+            elif isinstance(value, dict):
+                self.prune_fields(value, big_fields, is_in_list)
+                if len(value) == 0:
+                    empty_keys.append(key)
+            elif isinstance(value, list):
+                if len(value) == 0 or value == ['']:
+                    empty_keys.append(key)
+                    continue
                 for v in value:
                     if isinstance(v, dict):
-                        self.del_none(v)
-            if isinstance(value, dict):
-                self.del_none(value)
-            if isinstance(value, dict) and len(value) == 0:
-                del d[key]
-            elif (isinstance(value, list)
-                    and (len(value) == 0 or value == [''])):
-                del d[key]
-            elif isinstance(value, str) and (value in ('', '-', 'null', '[]')):
-                del d[key]
-            elif isinstance(value, type(None)):
-                del d[key]
+                        self.prune_fields(v, big_fields, True)
+        for key in empty_keys:
+            del d[key]
         return d
 
     def truncate_txt(self, txt, num):
-        try:
-            return txt.encode('utf-8')[:num].decode()
-        except UnicodeDecodeError:
-            return self.truncate_txt(txt, num - 1)
-
-    def truncate_big_field(self, d):
+        """truncate txt to num bytes of UTF-8 at boundary of character"""
+        data = txt.encode('utf-8')
+        if len(data) > num:
+            # 0b10xxxxxx is continuation byte of multibyte character
+            while num > 0 and (data[num] & 0xC0) == 0x80:
+                num -= 1
+        return data[:num].decode()
+
+    def truncate_big_fields(self, big_fields):
         """ truncate big field if size is bigger than 32,766 byte
 
         field size が Lucene の最大値である 32766 Byte を超えてるかチェック
         超えてれば切り捨て。このサイズは lucene の制限値
         """
-        for key, value in list(d.items()):
-            if isinstance(value, dict):
-                self.truncate_big_field(value)
-            elif (isinstance(value, str) and (len(value) >= 16383)
-                    and len(value.encode('utf-8', 'surrogatepass')) >= 32766):
-                if key not in ("@message", ):
-                    d[key] = self.truncate_txt(d[key], 32753) + '<<TRUNCATED>>'
-                    logger.warning(
-                        f'Data was truncated because the size of {key} field '
-                        f'is bigger than 32,766. _id is {self.doc_id}')
-        return d
+        is_truncated = False
+        for d, key, size in big_fields:
+            if size >= 32766:
+                d[key] = self.truncate_txt(d[key], 32753) + '<<TRUNCATED>>'
+                logger.warning(
+                    f'Data was truncated because the size of {key} field '
+                    f'is bigger than 32,766. _id is {self.doc_id}')
+                is_truncated = True
+        return is_truncated
 
 
 ###############################################################################
@@ -20,11 +20,16 @@ logger = Logger(child=True)
 
 
 class FileFormatBase(object):
+    # True if extract_log converts lograw with exclude_or_convert_lograw
+    prefilters_raw_log = False
+
     def __init__(self, rawdata=None, logconfig=None, logtype=None):
         self._rawdata = rawdata
         self.logconfig = logconfig
         self.logtype = logtype
         self._filename = None
+        self.exclusion_patterns = (
+            logconfig.get('exclusion_patterns') if logconfig else None)
 
     @property
     def filename(self):
@@ -83,3 +88,16 @@ class FileFormatBase(object):
 
     def convert_lograw_to_dict(self, lograw, logconfig=None):
         return lograw
+
+    def exclude_or_convert_lograw(self, lograw):
+        """convert lograw to dict unless it matches raw exclusion patterns.
+
+        @message の除外パターンに一致したログは、JSON や正規表現で
+        パースせずに除外済みの dict を返す
+        """
+        if self.exclusion_patterns:
+            matched = self.exclusion_patterns.match_raw(lograw)
+            if matched:
+                return {'is_ignored': True,
+                        'ignored_reason': f'matched {matched}'}
+        return self.convert_lograw_to_dict(lograw)
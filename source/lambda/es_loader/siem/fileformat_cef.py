@@ -9,6 +9,7 @@ __url__ = 'https://github.com/aws-samples/siem-on-amazon-opensearch-service'
 
 import re
 from functools import cached_property
+from itertools import islice
 
 from aws_lambda_powertools import Logger
 
@@ -22,6 +23,8 @@ RE_EXTENSION = r'([^=\s]+)=((?:[\\]=|[^=])+)(?:\s|$)'
 
 
 class FileFormatCef(FileFormatBase):
+    prefilters_raw_log = True
+
     @cached_property
     def log_count(self):
         return sum(1 for line in self.rawdata)
@@ -29,9 +32,9 @@ class FileFormatCef(FileFormatBase):
     def extract_log(self, start=0, end=0, logmeta={}):
         start_index = start - 1
         end_index = end
-        for logdata in self.rawdata.readlines()[start_index:end_index]:
+        for logdata in islice(self.rawdata, start_index, end_index):
             lograw = logdata.strip()
-            logdict = self.convert_lograw_to_dict(lograw)
+            logdict = self.exclude_or_convert_lograw(lograw)
             yield (lograw, logdict, logmeta)
 
     def convert_lograw_to_dict(self, lograw, logconfig=None):
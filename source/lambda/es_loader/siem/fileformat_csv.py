@@ -9,6 +9,7 @@ __url__ = 'https://github.com/aws-samples/siem-on-amazon-opensearch-service'
 
 import csv
 from functools import cached_property
+from itertools import islice
 
 from aws_lambda_powertools import Logger
 
@@ -27,15 +28,21 @@ class FileFormatCsv(FileFormatBase):
     @cached_property
     def log_count(self):
         header_num = self.ignore_header_line_number
-        # _line_count = len(self.rawdata.readlines())
-        _line_count = sum(1 for line in self.rawdata) - header_num
-        if self.csv_delimiter:
-            self.rawdata.seek(0)
-            spamreader = csv.reader(self.rawdata, delimiter=self.csv_delimiter)
-            _row_count = sum(1 for row in spamreader) - header_num
-        else:
+        if not self.csv_delimiter:
             self.is_multiline = False
-            return _line_count
+            return sum(1 for line in self.rawdata) - header_num
+        # lines and rows are counted in one pass
+        _line_count = -header_num
+
+        def count_lines(lines):
+            nonlocal _line_count
+            for line in lines:
+                _line_count += 1
+                yield line
+
+        spamreader = csv.reader(
+            count_lines(self.rawdata), delimiter=self.csv_delimiter)
+        _row_count = sum(1 for row in spamreader) - header_num
         if _line_count == _row_count:
             self.is_multiline = False
             return _line_count
@@ -56,7 +63,7 @@ class FileFormatCsv(FileFormatBase):
                 header = x
                 break
         else:
-            header = self.rawdata.readlines()[0].strip().split()
+            header = self.rawdata.readline().strip().split()
         header = [field.replace('-', '_') for field in header]
         return header
 
@@ -64,27 +71,20 @@ class FileFormatCsv(FileFormatBase):
         start_index = start - 1
         end_index = end
         if self.csv_delimiter:
-            try:
-                is_multiline = self.is_multiline
-            except AttributeError:
-                _line_count = sum(1 for line in self.rawdata)
-                self.rawdata.seek(0)
-                spamreader = csv.reader(
-                    self.rawdata, delimiter=self.csv_delimiter)
-                _row_count = sum(1 for row in spamreader)
-                self.rawdata.seek(0)
-                if _line_count == _row_count:
-                    is_multiline = False
-                else:
-                    is_multiline = True
+            if not hasattr(self, 'is_multiline'):
+                # is_multiline is detected while logs are counted
+                self.log_count
+            is_multiline = self.is_multiline
 
+        # read header before iterating lines because it rewinds rawdata
+        csv_header = self._csv_header
         if self.csv_delimiter and (is_multiline is False):
-            for logdata in self.rawdata.readlines()[start_index:end_index]:
+            for logdata in islice(self.rawdata, start_index, end_index):
                 lograw = logdata.strip()
                 lograw_tuple = None
                 for x in csv.reader([lograw], delimiter=self.csv_delimiter):
                     lograw_tuple = x
-                logdict = dict(zip(self._csv_header, lograw_tuple))
+                logdict = dict(zip(csv_header, lograw_tuple))
                 yield (lograw, logdict, logmeta)
         elif self.csv_delimiter and (is_multiline is True):
             if start <= 2:
@@ -100,9 +100,9 @@ class FileFormatCsv(FileFormatBase):
                     break
                 row_count += 1
         else:
-            for logdata in self.rawdata.readlines()[start_index:end_index]:
+            for logdata in islice(self.rawdata, start_index, end_index):
                 lograw = logdata.strip()
-                logdict = dict(zip(self._csv_header, lograw.split()))
+                logdict = dict(zip(csv_header, lograw.split()))
                 yield (lograw, logdict, logmeta)
 
     def convert_lograw_to_dict(self, lograw, logconfig=None):
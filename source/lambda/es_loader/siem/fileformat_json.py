@@ -28,7 +28,7 @@ class FileFormatJson(FileFormatBase):
         delimiter = self.json_delimiter
         count = 0
         # For ndjson
-        for line in self.rawdata.readlines():
+        for line in self.rawdata:
             # for Firehose's json (multiple jsons in 1 line)
             size = len(line)
             index = 0
@@ -52,7 +52,7 @@ class FileFormatJson(FileFormatBase):
         delimiter = self.logconfig['json_delimiter']
         count = 0
         # For ndjson
-        for line in self.rawdata.readlines():
+        for line in self.rawdata:
             # for Firehose's json (multiple jsons in 1 line)
             size = len(line)
             index = 0
@@ -68,14 +68,14 @@ class FileFormatJson(FileFormatBase):
                             yield (json.dumps(record, ensure_ascii=False),
                                    record, logmeta)
                         elif count > end:
-                            break
+                            return
                 elif not delimiter:
                     count += 1
                     if start <= count <= end:
                         yield (json.dumps(raw_event, ensure_ascii=False),
                                raw_event, logmeta)
                     elif count > end:
-                        break
+                        return
                 search = json.decoder.WHITESPACE.search(line, offset)
                 if search is None:
                     break
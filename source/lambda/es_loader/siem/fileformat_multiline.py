@@ -18,6 +18,8 @@ logger = Logger(child=True)
 
 
 class FileFormatMultiline(FileFormatBase):
+    prefilters_raw_log = True
+
     def __init__(self, rawdata=None, logconfig=None, logtype=None):
         super().__init__(rawdata, logconfig, logtype)
         self._multiline_firstline = None
@@ -81,7 +83,7 @@ class FileFormatMultiline(FileFormatBase):
                     if len(multilog) > 0:
                         # yield previous log
                         lograw = "".join(multilog).rstrip()
-                        logdict = self.convert_lograw_to_dict(lograw)
+                        logdict = self.exclude_or_convert_lograw(lograw)
                         yield (lograw, logdict, logmeta)
                     multilog = []
                     is_in_scope = True
@@ -95,7 +97,7 @@ class FileFormatMultiline(FileFormatBase):
         if is_in_scope:
             # yield last log
             lograw = "".join(multilog).rstrip()
-            logdict = self.convert_lograw_to_dict(lograw)
+            logdict = self.exclude_or_convert_lograw(lograw)
             yield (lograw, logdict, logmeta)
 
     def convert_lograw_to_dict(self, lograw, logconfig=None):
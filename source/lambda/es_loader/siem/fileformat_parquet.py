@@ -10,18 +10,72 @@ __url__ = 'https://github.com/aws-samples/siem-on-amazon-opensearch-service'
 from datetime import datetime
 from functools import cached_property
 
-try:
-    import numpy as np
-    import pandas as pd
-except ImportError:
-    np = None
-    pd = None
 from aws_lambda_powertools import Logger
 
 from siem import FileFormatBase
 
 logger = Logger(child=True)
 
+# pyarrow and pandas are imported when the first parquet object is found,
+# so logtypes without parquet don't pay their import time and memory
+np = None
+pa = None
+pd = None
+pq = None
+is_imported = False
+
+
+def import_parquet_libraries():
+    """import pyarrow, and pandas as fallback, only once.
+
+    pyarrow だけでパースできるので、pandas は pyarrow がない場合のみ使う
+    """
+    global np, pa, pd, pq, is_imported
+    if is_imported:
+        return
+    is_imported = True
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        logger.info('pyarrow is used to read parquet')
+        return
+    except ImportError:
+        pass
+    try:
+        import numpy as np
+        import pandas as pd
+        logger.info('pandas is used to read parquet')
+    except ImportError:
+        np = None
+        pd = None
+
+
+def to_microsecond_type(data_type):
+    """return data_type whose timestamp[ns] are replaced by timestamp[us].
+
+    datetime はマイクロ秒までしか扱えず、pandas がないと timestamp[ns] を
+    to_pylist で変換できないので、ナノ秒は切り捨てる
+    """
+    if pa.types.is_timestamp(data_type):
+        if data_type.unit == 'ns':
+            return pa.timestamp('us', tz=data_type.tz)
+    elif pa.types.is_struct(data_type):
+        return pa.struct([field.with_type(to_microsecond_type(field.type))
+                          for field in data_type])
+    elif pa.types.is_map(data_type):
+        key_field = data_type.key_field
+        item_field = data_type.item_field
+        return pa.map_(
+            key_field.with_type(to_microsecond_type(key_field.type)),
+            item_field.with_type(to_microsecond_type(item_field.type)))
+    elif pa.types.is_list(data_type):
+        return pa.list_(data_type.value_field.with_type(
+            to_microsecond_type(data_type.value_type)))
+    elif pa.types.is_large_list(data_type):
+        return pa.large_list(data_type.value_field.with_type(
+            to_microsecond_type(data_type.value_type)))
+    return data_type
+
 
 def clean_dict(d):
     for key, value in list(d.items()):
@@ -37,27 +91,102 @@ def clean_dict(d):
 
 
 class FileFormatParquet(FileFormatBase):
+    BATCH_SIZE = 10000
+
     def __init__(self, rawdata=None, logconfig=None, logtype=None):
         super().__init__(rawdata, logconfig, logtype)
-        if pd is None:
+        import_parquet_libraries()
+        self.parquet_file = None
+        if pq:
+            # only metadata is read here. row groups are read in extract_log
+            self.parquet_file = pq.ParquetFile(rawdata)
+        elif pd is None:
             return None
-        self.df = pd.read_parquet(rawdata)
+        else:
+            self.df = pd.read_parquet(rawdata)
 
     @cached_property
     def log_count(self):
+        if self.parquet_file:
+            return self.parquet_file.metadata.num_rows
         if pd is None:
-            logger.error('You need to deploy Pandas as Lambda layer manually')
+            logger.error('You need to deploy pyarrow or Pandas as Lambda '
+                         'layer manually')
             return 0
         return len(self.df.index)
 
     def extract_log(self, start, end, logmeta={}):
+        if self.parquet_file:
+            yield from self.extract_log_by_batch(start, end, logmeta)
+            return
+        if pd is None:
+            # neither pyarrow nor pandas. log_count logs the error
+            self.log_count
+            return
         start_index = start - 1
-        end_index = end
+        end_index = min(end, len(self.df.index))
         for i in range(start_index, end_index):
             df_clean = self.df[i:i + 1].dropna(axis=1, how='all')
             df_dict = df_clean.to_dict(orient='records')[0]
             df_dict = clean_dict(df_dict)
             yield (str(df_dict), df_dict, logmeta)
 
+    def extract_log_by_batch(self, start, end, logmeta={}):
+        """read only row groups from start to end by record batch.
+
+        レコードバッチ単位で列ごとに Python のオブジェクトに変換し、
+        全ての行が null の列はバッチ単位で除外する
+        """
+        start_index = start - 1
+        end_index = min(end, self.log_count)
+        metadata = self.parquet_file.metadata
+        row_groups = []
+        skip_rows = 0
+        first_row = 0
+        for i in range(metadata.num_row_groups):
+            num_rows = metadata.row_group(i).num_rows
+            if first_row + num_rows > start_index and first_row < end_index:
+                if not row_groups:
+                    skip_rows = start_index - first_row
+                row_groups.append(i)
+            first_row += num_rows
+        if not row_groups:
+            return
+        remaining_rows = end_index - start_index
+        schema = self.parquet_file.schema_arrow
+        us_types = {}
+        for field in schema:
+            us_type = to_microsecond_type(field.type)
+            if us_type != field.type:
+                us_types[field.name] = us_type
+        for batch in self.parquet_file.iter_batches(
+                batch_size=self.BATCH_SIZE, row_groups=row_groups):
+            if skip_rows >= batch.num_rows:
+                skip_rows -= batch.num_rows
+                continue
+            batch = batch.slice(skip_rows, remaining_rows)
+            skip_rows = 0
+            remaining_rows -= batch.num_rows
+            names = []
+            columns = []
+            for name, column in zip(batch.schema.names, batch.columns):
+                if column.null_count < batch.num_rows:
+                    if name in us_types:
+                        column = column.cast(us_types[name], safe=False)
+                    names.append(name)
+                    columns.append(column.to_pylist())
+            for values in zip(*columns):
+                logdict = {}
+                for name, value in zip(names, values):
+                    if value is None or (
+                            isinstance(value, float) and value != value):
+                        # same as dropna
+                        continue
+                    logdict[name] = value
+                logdict = clean_dict(logdict)
+                yield (str(logdict), logdict, logmeta)
+            if remaining_rows <= 0:
+                return
+
     def convert_lograw_to_dict(self, lograw, logconfig=None):
         return lograw
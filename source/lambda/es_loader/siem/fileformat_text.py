@@ -8,6 +8,7 @@ __author__ = 'Akihiro Nakajima'
 __url__ = 'https://github.com/aws-samples/siem-on-amazon-opensearch-service'
 
 from functools import cached_property
+from itertools import islice
 
 from aws_lambda_powertools import Logger
 
@@ -17,6 +18,8 @@ logger = Logger(child=True)
 
 
 class FileFormatText(FileFormatBase):
+    prefilters_raw_log = True
+
     def __init__(self, rawdata=None, logconfig=None, logtype=None):
         super().__init__(rawdata, logconfig, logtype)
         self._regex_error_count = {}
@@ -52,9 +55,9 @@ class FileFormatText(FileFormatBase):
     def extract_log(self, start, end, logmeta={}):
         start_index = start - 1
         end_index = end
-        for logdata in self.rawdata.readlines()[start_index:end_index]:
+        for logdata in islice(self.rawdata, start_index, end_index):
             lograw = logdata.strip()
-            logdict = self.convert_lograw_to_dict(lograw)
+            logdict = self.exclude_or_convert_lograw(lograw)
             yield (lograw, logdict, logmeta)
 
     def convert_lograw_to_dict(self, lograw, logconfig=None):
@@ -55,6 +55,7 @@ def initial_extract_action_outcome(logdata):
 
 
 class FileFormatWinEvtXml(FileFormatBase):
+    prefilters_raw_log = True
 
     @cached_property
     def log_count(self):
@@ -83,7 +84,7 @@ class FileFormatWinEvtXml(FileFormatBase):
             last_match = re_lastword.search(line)
             if first_match and last_match:
                 # it means one line. not multiline
-                logdict = self.convert_lograw_to_dict(line)
+                logdict = self.exclude_or_convert_lograw(line)
                 yield (line, logdict, logmeta)
                 is_in_scope = False
             elif first_match:
@@ -91,7 +92,7 @@ class FileFormatWinEvtXml(FileFormatBase):
             elif last_match:
                 multilog.append(line)
                 lograw = "".join(multilog)
-                logdict = self.convert_lograw_to_dict(lograw)
+                logdict = self.exclude_or_convert_lograw(lograw)
                 yield (lograw, logdict, logmeta)
                 is_in_scope = False
                 multilog = []
@@ -27,11 +27,12 @@ class GeoDB():
     NOT_FILE_FRESH_DURATION = 86400   # 24 hours
     RE_DIGIT = re.compile(r'\d')
 
-    def __init__(self, s3_session_config):
+    def __init__(self, s3_session_config, enabled=True):
+        # enabled=False creates instance without database
         self.s3_session_config = s3_session_config
         GEOIP_BUCKET = self._get_geoip_buckent_name()
         has_city_db, has_asn_db = False, False
-        if GEOIP_BUCKET:
+        if GEOIP_BUCKET and enabled:
             has_city_db = self._download_geoip_database(
                 GEOIP_BUCKET, self.GEOIP_DBS['city'])
             has_asn_db = self._download_geoip_database(
@@ -92,7 +93,9 @@ class GeoDB():
                 return True
 
         if not os.path.isfile(localfile):
-            s3geo = boto3.resource('s3', config=self.s3_session_config)
+            # GeoDB is created in thread. default session is not thread-safe
+            s3geo = boto3.session.Session().resource(
+                's3', config=self.s3_session_config)
             bucket = s3geo.Bucket(geoipbucket)
             s3obj = self.S3KEY_PREFIX + geodb_name
             try:
@@ -7,6 +7,7 @@ __license__ = 'MIT-0'
 __author__ = 'Akihiro Nakajima'
 __url__ = 'https://github.com/aws-samples/siem-on-amazon-opensearch-service'
 
+import bisect
 import configparser
 import datetime
 # import gzip
@@ -23,6 +24,45 @@ from aws_lambda_powertools import Logger
 logger = Logger(child=True)
 
 
+class IntervalIndex():
+    """Index of integer intervals to find all intervals containing a point.
+
+    区間の開始値と終了値+1 で数直線を互いに重ならない区間 (elementary
+    segment) に分割し、各区間にそれを含む元の区間の値を持たせる。検索は
+    bisect だけなので、広いネットワークが含まれていても O(log n) になる
+    """
+    def __init__(self, intervals):
+        # intervals: iterable of (start, end, value)
+        intervals = list(intervals)
+        self.count = len(intervals)
+        starts = sorted((x[0], i) for i, x in enumerate(intervals))
+        ends = sorted((x[1] + 1, i) for i, x in enumerate(intervals))
+        self.bounds = []
+        self.segments = []
+        active = set()
+        i_start = i_end = 0
+        for bound in sorted({x[0] for x in starts} | {x[0] for x in ends}):
+            while i_end < self.count and ends[i_end][0] == bound:
+                active.discard(ends[i_end][1])
+                i_end += 1
+            while i_start < self.count and starts[i_start][0] == bound:
+                active.add(starts[i_start][1])
+                i_start += 1
+            self.bounds.append(bound)
+            # values are kept in the order of intervals
+            self.segments.append(
+                tuple(intervals[i][2] for i in sorted(active)))
+
+    def __len__(self):
+        return self.count
+
+    def search(self, point):
+        i = bisect.bisect_right(self.bounds, point) - 1
+        if i < 0:
+            return ()
+        return self.segments[i]
+
+
 class DB():
     DB_FILE = 'ioc.db'
     S3KEY_PREFIX = 'IOC'
@@ -33,10 +73,11 @@ class DB():
     NOT_FILE_FRESH_DURATION = 43200   # 12 hours
     RE_IPADDR = re.compile(r'[0-9a-fA-F:.]*$')
 
-    def __init__(self, s3_session_config):
+    def __init__(self, s3_session_config, enabled=True):
+        # enabled=False creates instance without database
         self.GEOIP_BUCKET = self._get_geoip_buckent_name()
         self.s3_session_config = s3_session_config
-        has_ioc_db = self._download_database()
+        has_ioc_db = enabled and self._download_database()
         self.cur = None
         if has_ioc_db:
             with sqlite3.connect(self.DB_FILE_LOCAL) as conn_file:
@@ -54,6 +95,9 @@ class DB():
                     count = self.cur.fetchone()[0]
                     if count >= 2:
                         self.is_enabled = True
+                        self.ipv4_index, self.ipv6_index = (
+                            self._create_ipaddress_index())
+                        self.domain_index = self._create_domain_index()
                     else:
                         self.is_enabled = False
                 except Exception:
@@ -120,7 +164,9 @@ class DB():
                 return True
 
         if not os.path.isfile(self.DB_FILE_LOCAL):
-            _s3 = boto3.resource('s3', config=self.s3_session_config)
+            # DB is created in thread. default session is not thread-safe
+            _s3 = boto3.session.Session().resource(
+                's3', config=self.s3_session_config)
             bucket = _s3.Bucket(self.GEOIP_BUCKET)
             try:
                 bucket.download_file(self.DB_FILE_S3KEY, self.DB_FILE_LOCAL)
@@ -162,6 +208,62 @@ class DB():
                 del d[key]
         return d
 
+    def _create_ipaddress_index(self):
+        """load ipaddress table into interval index of IPv4 and IPv6.
+
+        IPv6 は 3 つの列 (上位 48bit, 中位 48bit, 下位 32bit) に
+        分割されて保存されているので、128bit の整数に戻す
+        """
+        ipv4_intervals = []
+        ipv6_intervals = []
+        self.cur.execute(
+            """SELECT type, v6_network1_start, v6_network1_end,
+                v6_network2_start, v6_network2_end, network_start,
+                network_end, provider, name, reference, first_seen,
+                last_seen, modified, description
+            FROM ipaddress""")
+        for res in self.cur.fetchall():
+            (ioc_type, v6_network1_start, v6_network1_end, v6_network2_start,
+             v6_network2_end, network_start, network_end) = res[:7]
+            (provider, ioc_name, reference, first_seen, last_seen, modified,
+             description) = res[7:]
+            value = (provider, ioc_type, ioc_name, reference, first_seen,
+                     last_seen, modified, description)
+            if ioc_type == 'ipv4-addr':
+                ipv4_intervals.append((network_start, network_end, value))
+            elif ioc_type == 'ipv6-addr':
+                start = ((v6_network1_start << 80) | (v6_network2_start << 32)
+                         | network_start)
+                end = ((v6_network1_end << 80) | (v6_network2_end << 32)
+                       | network_end)
+                ipv6_intervals.append((start, end, value))
+        ipv4_index = IntervalIndex(ipv4_intervals)
+        ipv6_index = IntervalIndex(ipv6_intervals)
+        logger.info(f'IOC index of {len(ipv4_index)} IPv4 and '
+                    f'{len(ipv6_index)} IPv6 networks was created')
+        return ipv4_index, ipv6_index
+
+    def _create_domain_index(self):
+        """load domain table into dict of domain name.
+
+        親ドメインでも一致するように、検索時はラベル単位で短くした
+        サフィックスを順に引く
+        """
+        domain_index = {}
+        self.cur.execute(
+            """SELECT domain, provider, type, name, reference, first_seen,
+                last_seen, modified, description
+            FROM domain
+            WHERE type = ?""",
+            ('domain-name', ))
+        for res in self.cur.fetchall():
+            if not res[0]:
+                continue
+            domain = res[0].lower().rstrip('.')
+            domain_index.setdefault(domain, []).append(res[1:])
+        logger.info(f'IOC index of {len(domain_index)} domains was created')
+        return domain_index
+
     def _enrich_ipaddress(self, ip_str):
         try:
             ip = ipaddress.ip_address(ip_str)
@@ -171,47 +273,11 @@ class DB():
         if ip.is_private:
             return None
         if ip.version == 4:
-            self.cur.execute(
-                """SELECT provider, type, name, reference, first_seen,
-                    last_seen, modified, description
-                FROM (
-                    SELECT provider, type, name, reference, first_seen,
-                        last_seen, modified, description, network_end
-                    FROM ipaddress
-                    WHERE network_start <= ?
-                        ORDER BY network_start DESC
-                        LIMIT 300)
-                WHERE type = 'ipv4-addr'
-                    AND network_end >= ?""",
-                (ip_int, ip_int))
+            matches = self.ipv4_index.search(ip_int)
         else:
-            ip_int_upper = ip_int >> 80
-            ip_int_middle = ip_int >> 32 & (1 << 48) - 1
-            ip_int_lower = ip_int & (1 << 32) - 1
-            self.cur.execute(
-                """SELECT provider, type, name, reference, first_seen,
-                    last_seen, modified, description
-                FROM (
-                    SELECT provider, type, name, reference, first_seen,
-                        last_seen, modified, description, network_end,
-                        v6_network2_start, v6_network2_end,
-                        v6_network1_start, v6_network1_end
-                    FROM ipaddress
-                    WHERE network_start <= ?
-                        ORDER BY network_start DESC
-                        LIMIT 300)
-                WHERE type = 'ipv6-addr'
-                    AND network_end >= ?
-                    AND v6_network2_start <= ?
-                    AND v6_network2_end >= ?
-                    AND v6_network1_start <= ?
-                    AND v6_network1_end >= ?
-                    """,
-                (ip_int_lower, ip_int_lower,
-                 ip_int_middle, ip_int_middle,
-                 ip_int_upper, ip_int_upper))
+            matches = self.ipv6_index.search(ip_int)
         enrichments = []
-        for res in self.cur.fetchall():
+        for res in matches:
             (provider, ioc_type, ioc_name, reference, first_seen,
              last_seen, modified, description) = res
             enrichment = {
@@ -229,27 +295,27 @@ class DB():
 
     def _enrich_domain(self, domain):
         enrichments = []
-        self.cur.execute(
-            """SELECT provider, type, name, reference, first_seen,
-                      last_seen, modified, description
-            FROM domain
-            WHERE type = ?
-                AND domain = ?""",
-            ('domain-name', domain))
-        for res in self.cur.fetchall():
-            (provider, ioc_type, ioc_name, reference, first_seen,
-             last_seen, modified, description) = res
-            enrichment = {
-                'indicator': {
-                    'provider': provider, 'name': ioc_name,
-                    'first_seen': first_seen, 'last_seen': last_seen,
-                    'modified_at': modified, 'reference': reference,
-                    'type': ioc_type, 'description': description
-                },
-                'matched': {
-                    'atomic': domain, 'field': []
+        if not isinstance(domain, str):
+            return enrichments
+        labels = domain.lower().rstrip('.').split('.')
+        # www.evil.example, evil.example, example の順に検索する
+        for i in range(len(labels)):
+            suffix = '.'.join(labels[i:])
+            for res in self.domain_index.get(suffix, ()):
+                (provider, ioc_type, ioc_name, reference, first_seen,
+                 last_seen, modified, description) = res
+                enrichment = {
+                    'indicator': {
+                        'provider': provider, 'name': ioc_name,
+                        'first_seen': first_seen, 'last_seen': last_seen,
+                        'modified_at': modified, 'reference': reference,
+                        'type': ioc_type, 'description': description,
+                        'url': {'domain': suffix}
+                    },
+                    'matched': {
+                        'atomic': domain, 'field': []
+                    }
                 }
-            }
-            enrichment = self._del_none(enrichment)
-            enrichments.append(enrichment)
+                enrichment = self._del_none(enrichment)
+                enrichments.append(enrichment)
         return enrichments
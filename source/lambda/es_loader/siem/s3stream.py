@@ -0,0 +1,92 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+__copyright__ = ('Copyright Amazon.com, Inc. or its affiliates. '
+                 'All Rights Reserved.')
+__version__ = '2.10.4'
+__license__ = 'MIT-0'
+__author__ = 'Akihiro Nakajima'
+__url__ = 'https://github.com/aws-samples/siem-on-amazon-opensearch-service'
+
+import io
+
+from aws_lambda_powertools import Logger
+
+logger = Logger(child=True)
+
+
+class S3StreamingObject(io.RawIOBase):
+    """Seekable and read-only file object of S3 object.
+
+    S3 オブジェクトをチャンク単位で読み込むファイルオブジェクト。
+    seek された場合は Range 指定の GetObject で開き直すので、
+    オブジェクトのサイズに関係なくメモリ使用量は一定になる。
+    """
+    CHUNK_SIZE = 1048576   # 1 MiB
+
+    def __init__(self, s3_client, s3bucket, s3key, size, response=None):
+        super().__init__()
+        self.s3_client = s3_client
+        self.s3bucket = s3bucket
+        self.s3key = s3key
+        self.size = size
+        self._pos = 0
+        self._body = None
+        if response:
+            self._body = response['Body']
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f'negative seek position {offset}')
+        if offset != self._pos:
+            self._close_body()
+            self._pos = offset
+        return self._pos
+
+    def readinto(self, buffer):
+        if self._pos >= self.size:
+            return 0
+        if self._body is None:
+            self._open_body()
+        data = self._body.read(len(buffer))
+        size = len(data)
+        buffer[:size] = data
+        self._pos += size
+        return size
+
+    def close(self):
+        self._close_body()
+        super().close()
+
+    def _open_body(self):
+        params = {'Bucket': self.s3bucket, 'Key': self.s3key}
+        if self._pos > 0:
+            params['Range'] = f'bytes={self._pos}-'
+        logger.debug({'reopen_s3_object': f's3://{self.s3bucket}/{self.s3key}',
+                      'position': self._pos})
+        self._body = self.s3_client.get_object(**params)['Body']
+
+    def _close_body(self):
+        if self._body is not None:
+            try:
+                self._body.close()
+            except Exception:
+                pass
+            self._body = None
+
+
+def open_s3_stream(s3_client, s3bucket, s3key, size, response=None):
+    raw = S3StreamingObject(s3_client, s3bucket, s3key, size, response)
+    return io.BufferedReader(raw, buffer_size=S3StreamingObject.CHUNK_SIZE)
@@ -12,15 +12,26 @@ import urllib.parse
 from functools import lru_cache
 
 from aws_lambda_powertools import Logger
-from ua_parser import user_agent_parser
 
 logger = Logger(child=True)
 
+# ua_parser compiles all of its regexes when it is imported, so it is imported
+# when user agent is enriched for the first time to reduce cold start time
+user_agent_parser = None
+
 RE_AWS_USER_AGENT = re.compile(r'^(AWS Internal|[\w\.-]+?\.amazonaws.com)$')
 
 
+def import_ua_parser():
+    global user_agent_parser
+    if user_agent_parser is None:
+        from ua_parser import user_agent_parser as _user_agent_parser
+        user_agent_parser = _user_agent_parser
+
+
 @lru_cache(maxsize=100000)
 def enrich(original):
+    import_ua_parser()
     if '%20' in original:
         original = urllib.parse.unquote(original)
     parsed_string = user_agent_parser.Parse(original)
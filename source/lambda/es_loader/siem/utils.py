@@ -10,14 +10,19 @@ __url__ = 'https://github.com/aws-samples/siem-on-amazon-opensearch-service'
 import configparser
 import csv
 import importlib
+import importlib.util
 import ipaddress
 import json
+import operator
 import os
 import re
 import sys
+import threading
+import time
 import urllib.parse
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timedelta, timezone
 from functools import lru_cache
+from numbers import Number
 
 import boto3
 import botocore
@@ -26,22 +31,55 @@ import requests
 from aws_lambda_powertools import Logger
 from opensearchpy import AWSV4SignerAuth, OpenSearch, RequestsHttpConnection
 
+# numpy is not imported here to reduce cold start time. ndarray exists only
+# after numpy is imported by parquet reader
+HAS_NUMPY = importlib.util.find_spec('numpy') is not None
+
+# orjson is a native wheel and es-loader runs on both x86_64 and arm64,
+# so it is not in requirements.txt. Add it as a Lambda layer built for the
+# architecture of the function to use it
 try:
-    import numpy as np
+    import orjson
 except ImportError:
-    np = None
+    orjson = None
 
 logger = Logger(child=True)
 
+# JSON_ENCODER=json forces the standard library even if orjson is installed
+if os.environ.get('JSON_ENCODER', '').lower() == 'json':
+    orjson = None
+if orjson:
+    ORJSON_OPTION = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+    JSON_BACKEND = f'orjson {orjson.__version__}'
+else:
+    JSON_BACKEND = 'json'
+
 
 class MyEncoder(json.JSONEncoder):
     def default(self, obj):
-        if np:
-            if isinstance(obj, np.ndarray):
+        if isinstance(obj, (datetime, date)):
+            return obj.isoformat()
+        if HAS_NUMPY:
+            np = sys.modules.get('numpy')
+            if np and isinstance(obj, np.ndarray):
                 return obj.tolist()
             return json.JSONEncoder.default(self, obj)
 
 
+def json_dumps(obj):
+    """serialize obj to JSON as bytes.
+
+    orjson がインストールされていれば使用し、なければ標準ライブラリを使う。
+    orjson で変換できない値 (64bit を超える整数など) も標準ライブラリで変換する
+    """
+    if orjson:
+        try:
+            return orjson.dumps(obj, option=ORJSON_OPTION)
+        except TypeError:
+            pass
+    return json.dumps(obj, cls=MyEncoder).encode()
+
+
 class AutoRefreshableSession:
     region = os.environ.get('AWS_REGION', 'us-east-1')
     if region.startswith('cn-'):
@@ -54,11 +92,13 @@ class AutoRefreshableSession:
         self.role_session_name = role_session_name
         self.external_id = external_id
         self.long_running_session = None
+        # created in thread of lambda init. default session is not thread-safe
+        self.sts_client = boto3.session.Session().client(
+            'sts', region_name=self.region, endpoint_url=self.endpoint_url)
         self.create_auto_refreshable_session()
 
     def _refresh(self):
-        sts_client = boto3.client(
-            'sts', region_name=self.region, endpoint_url=self.endpoint_url)
+        sts_client = self.sts_client
         params = {
             'RoleArn': self.role_arn,
             'RoleSessionName': self.role_session_name,
@@ -107,6 +147,18 @@ MONTH_TO_INT = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
                 'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
 NOW = datetime.now(timezone.utc)
 TD_OFFSET12 = timedelta(hours=12)
+# regex of directives of strptime. same as _strptime.TimeRE of locale C,
+# but names of month, weekday and AM/PM are case sensitive
+STRPTIME_DIRECTIVES = {
+    'Y': r'(?P<Y>\d\d\d\d)', 'y': r'(?P<y>\d\d)',
+    'm': r'(?P<m>1[0-2]|0[1-9]|[1-9])',
+    'b': '(?P<b>' + '|'.join(MONTH_TO_INT) + ')',
+    'd': r'(?P<d>3[01]|[12]\d|0[1-9]|[1-9]| [1-9])',
+    'a': '(?P<a>Mon|Tue|Wed|Thu|Fri|Sat|Sun)',
+    'H': r'(?P<H>2[0-3]|[0-1]\d|\d)', 'I': r'(?P<I>1[0-2]|0[1-9]|[1-9])',
+    'p': '(?P<p>AM|PM)', 'M': r'(?P<M>[0-5]\d|\d)',
+    'S': r'(?P<S>6[0-1]|[0-5]\d|\d)', 'f': r'(?P<f>[0-9]{1,6})',
+    'z': r'(?P<z>Z|[+-]\d\d[0-5]\d)'}
 TIMEZONE_UTC = timezone(timedelta(hours=0))
 RE_NOT_FRAGMENT_STR = re.compile(r'[&(){}@_;<>\s]')
 
@@ -347,6 +399,10 @@ def convert_timestr_to_datetime(timestr, timestamp_key, timestamp_format, TZ):
 
 @lru_cache(maxsize=1024)
 def convert_epoch_to_datetime(timestr, TZ=timezone.utc):
+    return parse_epoch(timestr, TZ)
+
+
+def parse_epoch(timestr, TZ=timezone.utc):
     try:
         epoch = float(timestr)
     except ValueError:
@@ -414,6 +470,11 @@ def convert_syslog_to_datetime(timestr, TZ):
 
 @lru_cache(maxsize=1024)
 def convert_iso8601_to_datetime(timestr, TZ, timestamp_key):
+    return parse_iso8601(timestr, TZ)
+
+
+def parse_iso8601(timestr, TZ):
+    # fromisoformat accepts Z and fraction of any length since python 3.11
     try:
         dt = datetime.fromisoformat(timestr)
     except ValueError:
@@ -442,6 +503,176 @@ def convert_custom_timeformat_to_datetime(timestr, TZ, timestamp_format,
     return dt
 
 
+def compile_strptime_format(timestamp_format):
+    """compile format of strptime into regex.
+
+    %z 以外のタイムゾーンや週番号などは未対応で None を返す
+
+    >>> regex = compile_strptime_format('%d/%b/%Y:%H:%M')
+    >>> regex.fullmatch('01/May/2024:12:00').groupdict()
+    {'d': '01', 'b': 'May', 'Y': '2024', 'H': '12', 'M': '00'}
+    >>> compile_strptime_format('%Y-%j') is None
+    True
+    """
+    pattern = []
+    directives = set()
+    i = 0
+    while i < len(timestamp_format):
+        char = timestamp_format[i]
+        if char != '%':
+            pattern.append(re.escape(char))
+            i += 1
+            continue
+        directive = timestamp_format[i + 1:i + 2]
+        i += 2
+        if directive == '%':
+            pattern.append('%')
+        elif directive in STRPTIME_DIRECTIVES and directive not in directives:
+            pattern.append(STRPTIME_DIRECTIVES[directive])
+            directives.add(directive)
+        else:
+            return None
+    if ({'Y', 'y'} <= directives or {'m', 'b'} <= directives
+            or {'H', 'I'} <= directives):
+        return None
+    return re.compile(''.join(pattern))
+
+
+@lru_cache(maxsize=64)
+def get_timezone_of_utcoffset(utcoffset):
+    if utcoffset == 'Z':
+        return timezone.utc
+    seconds = int(utcoffset[1:3]) * 3600 + int(utcoffset[3:5]) * 60
+    if utcoffset[0] == '-':
+        seconds = -seconds
+    return timezone(timedelta(seconds=seconds))
+
+
+def create_custom_timeformat_parser(timestamp_format):
+    """return parser which is faster than strptime.
+
+    正規表現で分解して datetime を作り、一致しない文字列や不正な値は
+    strptime で変換する
+    """
+    regex = compile_strptime_format(timestamp_format)
+    if not regex:
+        return lambda timestr, TZ: convert_custom_timeformat_to_datetime(
+            timestr, TZ, timestamp_format, None)
+
+    # index of each directive in m.groups()
+    index = {name: i - 1 for name, i in regex.groupindex.items()}
+    i_year = index.get('Y', index.get('y'))
+    is_short_year = 'y' in index
+    i_month = index.get('m')
+    i_month_name = index.get('b')
+    i_day = index.get('d')
+    i_hour = index.get('H', index.get('I'))
+    is_12hour = 'I' in index
+    i_ampm = index.get('p')
+    i_minute = index.get('M')
+    i_second = index.get('S')
+    i_fraction = index.get('f')
+    i_utcoffset = index.get('z')
+
+    def parse_custom_timeformat(timestr, TZ):
+        m = regex.fullmatch(timestr) if isinstance(timestr, str) else None
+        if m:
+            g = m.groups()
+            year = 1900
+            if i_year is not None:
+                year = int(g[i_year])
+                if is_short_year:
+                    year += 2000 if year <= 68 else 1900
+            if i_month is not None:
+                month = int(g[i_month])
+            elif i_month_name is not None:
+                month = MONTH_TO_INT[g[i_month_name]]
+            else:
+                month = 1
+            hour = 0
+            if i_hour is not None:
+                hour = int(g[i_hour])
+                if is_12hour:
+                    if i_ampm is not None and g[i_ampm] == 'PM':
+                        if hour != 12:
+                            hour += 12
+                    elif hour == 12:
+                        hour = 0
+            try:
+                if i_utcoffset is not None:
+                    tzinfo = get_timezone_of_utcoffset(g[i_utcoffset])
+                else:
+                    tzinfo = TZ or None
+                return datetime(
+                    year, month,
+                    int(g[i_day]) if i_day is not None else 1,
+                    hour,
+                    int(g[i_minute]) if i_minute is not None else 0,
+                    int(g[i_second]) if i_second is not None else 0,
+                    (int(g[i_fraction].ljust(6, '0'))
+                     if i_fraction is not None else 0),
+                    tzinfo=tzinfo)
+            except ValueError:
+                pass
+        return convert_custom_timeformat_to_datetime(
+            timestr, TZ, timestamp_format, None)
+    return parse_custom_timeformat
+
+
+def create_timestamp_parser(timestamp_format):
+    """return function to convert timestr into datetime with TZ.
+
+    convert_timestr_to_datetime と同じ結果を返すが、フォーマットの判定を
+    事前に済ませ、カーディナリティが高い ISO8601 と epoch は lru_cache を
+    使わない
+    """
+    if not timestamp_format:
+        return lambda timestr, TZ: None
+    elif 'epoch' in timestamp_format:
+        return parse_epoch
+    elif 'syslog' in timestamp_format:
+        return convert_syslog_to_datetime
+    elif 'iso8601' in timestamp_format:
+        return parse_iso8601
+    return create_custom_timeformat_parser(timestamp_format)
+
+
+class TimestampParser:
+    """parser of timestamp with formats of timestamp_format_list.
+
+    前回一致したフォーマットから試すので、フォーマットが混在するログでも
+    通常は一回で変換できる。フォーマットの順番が結果に影響しないように、
+    timestamp_format_list には一つの文字列に二つ以上一致しないフォーマットを
+    指定する
+
+    >>> parser = TimestampParser(['iso8601', '%d/%b/%Y:%H:%M:%S %z'])
+    >>> parser('01/May/2024:12:00:00 +0900', TIMEZONE_UTC)
+    datetime.datetime(2024, 5, 1, 12, 0, tzinfo=datetime.timezone(\
+datetime.timedelta(seconds=32400)))
+    >>> parser.last_index
+    1
+    """
+    def __init__(self, timestamp_format_list):
+        if not isinstance(timestamp_format_list, list):
+            timestamp_format_list = [timestamp_format_list, ]
+        self.parsers = [create_timestamp_parser(x)
+                        for x in timestamp_format_list]
+        self.last_index = 0
+
+    def __call__(self, timestr, TZ):
+        dt = self.parsers[self.last_index](timestr, TZ)
+        if dt:
+            return dt
+        for i, parser in enumerate(self.parsers):
+            if i == self.last_index:
+                continue
+            dt = parser(timestr, TZ)
+            if dt:
+                self.last_index = i
+                return dt
+        return None
+
+
 #############################################################################
 # Amazon OpenSearch Service / AWS Resouce
 #############################################################################
@@ -523,6 +754,49 @@ def get_read_only_indices(es_conn, awsauth, ES_HOSTNAME):
     return tuple(sorted(list(set(read_only_indices))))
 
 
+class ReadOnlyIndices:
+    """Registry of read-only indices which is refreshed while warm.
+
+    ISM によってウォーム中にインデックスが UltraWarm/cold に移行、または
+    クローズされることがあるので、ttl 秒毎と、書き込みがブロックされた
+    レスポンスを受け取った時に loader で再取得する
+    """
+    def __init__(self, indices=(), loader=None, ttl=300, min_interval=10):
+        self._indices = tuple(indices)
+        self._loader = loader
+        self.ttl = ttl
+        # refresh is skipped if it was refreshed in min_interval sec
+        self.min_interval = min_interval
+        self._refreshed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def indices(self):
+        if self._loader and time.monotonic() - self._refreshed_at > self.ttl:
+            self.refresh()
+        return self._indices
+
+    def refresh(self):
+        if not self._loader:
+            return self._indices
+        with self._lock:
+            if time.monotonic() - self._refreshed_at < self.min_interval:
+                return self._indices
+            try:
+                indices = tuple(self._loader())
+            except Exception:
+                logger.exception('impossible to refresh read only indices')
+                indices = self._indices
+            self._refreshed_at = time.monotonic()
+            if indices != self._indices:
+                logger.info(json.dumps({'READ_ONLY_INDICES': indices}))
+                self._indices = indices
+        return self._indices
+
+    def get_writable_indexname(self, indexname):
+        return get_writable_indexname(indexname, self.indices)
+
+
 @lru_cache(maxsize=1024)
 def get_writable_indexname(indexname, READ_ONLY_INDICES):
     if indexname not in READ_ONLY_INDICES:
@@ -639,7 +913,8 @@ def get_ssm_params(parameters_prefix):
     config = botocore.config.Config(
         connect_timeout=2,
         retries={"total_max_attempts": 1, "max_attempts": 1})
-    ssm_client = boto3.client('ssm', config=config)
+    # called in thread of lambda init. default session is not thread-safe
+    ssm_client = boto3.session.Session().client('ssm', config=config)
     try:
         res = ssm_client.get_parameters_by_path(
             Path=parameters_prefix, Recursive=True, WithDecryption=False,
@@ -694,6 +969,8 @@ def get_exclusion_conditions():
         try:
             expression = parameter['expression']
             parameter['compiled_expression'] = jmespath.compile(expression)
+            parameter['predicate'] = compile_jmespath_predicate(
+                parameter['compiled_expression'])
         except Exception:
             # logger.append_keys(expression=expression)
             # github.com/aws-powertools/powertools-lambda-python/issues/1016
@@ -718,18 +995,170 @@ def get_exclusion_conditions():
     return exclusion_conditions
 
 
-def load_modules_on_memory(etl_config, user_libs):
-    for logtype in etl_config:
-        if etl_config[logtype].get('script_ecs'):
-            mod_name = 'sf_' + logtype.replace('-', '_')
-            # old_mod_name is for compatibility
-            old_mod_name = 'sf_' + logtype
-            if mod_name + '.py' in user_libs:
-                importlib.import_module(mod_name)
-            elif old_mod_name + '.py' in user_libs:
-                importlib.import_module(mod_name)
-            else:
-                importlib.import_module('siem.' + mod_name)
+JMESPATH_ORDERING_FUNC = {
+    'lt': operator.lt, 'gt': operator.gt, 'lte': operator.le,
+    'gte': operator.ge}
+
+
+def _is_jmespath_false(value):
+    # false values of JMESPath are different from python
+    return (value == '' or value == [] or value == {} or value is None
+            or value is False)
+
+
+def _is_jmespath_number(value):
+    return isinstance(value, Number) and not isinstance(value, bool)
+
+
+def _jmespath_equals(x, y):
+    # 0/1 are not equal to False/True in JMESPath
+    if _is_jmespath_number(x) and x in (0, 1):
+        return not isinstance(y, bool) and x == y
+    elif _is_jmespath_number(y) and y in (0, 1):
+        return not isinstance(x, bool) and x == y
+    return x == y
+
+
+def _get_jmespath_field(value, path):
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def _compile_jmespath_node(node):
+    """compile node of JMESPath AST into python function.
+
+    フィールド参照、比較、&&, ||, !, contains, starts_with, ends_with だけを
+    サポートし、それ以外は None を返してインタプリタで評価させる。
+    型が不正でインタプリタが例外を投げる値では TypeError を投げる
+    """
+    node_type = node['type']
+    children = node.get('children', [])
+    if node_type == 'field' or (
+            node_type == 'subexpression'
+            and all(x['type'] == 'field' for x in children)):
+        path = tuple(x['value'] for x in children) or (node['value'], )
+        if len(path) == 1:
+            key = path[0]
+            return lambda v: v.get(key) if isinstance(v, dict) else None
+        return lambda v: _get_jmespath_field(v, path)
+    elif node_type == 'current':
+        return lambda v: v
+    elif node_type == 'literal':
+        literal = node['value']
+        return lambda v: literal
+    funcs = [_compile_jmespath_node(x) for x in children]
+    if None in funcs:
+        return None
+    if node_type == 'subexpression':
+        def subexpression(v):
+            for func in funcs:
+                v = func(v)
+            return v
+        return subexpression
+    elif node_type == 'and_expression':
+        left, right = funcs
+
+        def and_expression(v):
+            x = left(v)
+            return x if _is_jmespath_false(x) else right(v)
+        return and_expression
+    elif node_type == 'or_expression':
+        left, right = funcs
+
+        def or_expression(v):
+            x = left(v)
+            return right(v) if _is_jmespath_false(x) else x
+        return or_expression
+    elif node_type == 'not_expression':
+        func = funcs[0]
+
+        def not_expression(v):
+            x = func(v)
+            # !0 is false in JMESPath
+            return False if _is_jmespath_number(x) and x == 0 else not x
+        return not_expression
+    elif node_type == 'comparator':
+        left, right = funcs
+        comparator = node['value']
+        if (comparator in ('eq', 'ne') and children[1]['type'] == 'literal'
+                and isinstance(children[1]['value'], str)):
+            # string literal is never equal to numbers and booleans
+            literal = children[1]['value']
+            if comparator == 'eq':
+                return lambda v: left(v) == literal
+            return lambda v: left(v) != literal
+        elif comparator == 'eq':
+            return lambda v: _jmespath_equals(left(v), right(v))
+        elif comparator == 'ne':
+            return lambda v: not _jmespath_equals(left(v), right(v))
+        compare = JMESPATH_ORDERING_FUNC.get(comparator)
+        if not compare:
+            return None
+
+        def ordering(v):
+            # ordering operators are valid only for numbers and strings
+            x, y = left(v), right(v)
+            if not ((_is_jmespath_number(x) or isinstance(x, str))
+                    and (_is_jmespath_number(y) or isinstance(y, str))):
+                return None
+            return compare(x, y)
+        return ordering
+    elif node_type == 'function_expression' and len(funcs) == 2:
+        subject, search = funcs
+        if node['value'] == 'contains':
+            def contains(v):
+                x = subject(v)
+                if not isinstance(x, (str, list)):
+                    raise TypeError('invalid type for contains')
+                return search(v) in x
+            return contains
+        elif node['value'] in ('starts_with', 'ends_with'):
+            method = (str.startswith if node['value'] == 'starts_with'
+                      else str.endswith)
+
+            def starts_or_ends_with(v):
+                x, y = subject(v), search(v)
+                if not (isinstance(x, str) and isinstance(y, str)):
+                    raise TypeError(f'invalid type for {node["value"]}')
+                return method(x, y)
+            return starts_or_ends_with
+    return None
+
+
+def compile_jmespath_predicate(compiled_expression):
+    """return python function equivalent to compiled_expression.search.
+
+    >>> predicate = compile_jmespath_predicate(jmespath.compile(
+    ...     "eventName == 'GetObject' && starts_with(user.arn, 'arn:')"))
+    >>> predicate({'eventName': 'GetObject', 'user': {'arn': 'arn:aws'}})
+    True
+    >>> predicate({'eventName': 'PutObject'})
+    False
+    >>> predicate.is_compiled
+    True
+    >>> predicate = compile_jmespath_predicate(jmespath.compile(
+    ...     "Records[?eventName == 'GetObject']"))
+    >>> predicate.is_compiled
+    False
+    """
+    func = _compile_jmespath_node(compiled_expression.parsed)
+    if func is None:
+        def interpreter(record):
+            return compiled_expression.search(record)
+        interpreter.is_compiled = False
+        return interpreter
+
+    def predicate(record):
+        try:
+            return func(record)
+        except Exception:
+            # the interpreter raises the same error or handles the value
+            return compiled_expression.search(record)
+    predicate.is_compiled = True
+    return predicate
 
 
 def load_sf_module(logfile, logconfig, user_libs_list):
@@ -836,15 +1265,187 @@ def get_exclude_log_patterns_csv_filename(etl_config):
 
 
 def merge_log_exclusion_patterns(patterns1, patterns2) -> dict:
+    """merge patterns of each log type and compile them into matcher.
+
+    >>> re_ip = re.compile('192.0.2.1$')
+    >>> patterns = merge_log_exclusion_patterns(
+    ...     {'vpcflowlogs': [{'srcaddr': re_ip}]}, {'cloudtrail': []})
+    >>> sorted(patterns)
+    ['vpcflowlogs']
+    >>> patterns['vpcflowlogs'].match({'srcaddr': '192.0.2.1'})
+    '{srcaddr: 192.0.2.1} with log_exclusion_patterns[0] srcaddr: 192.0.2.1$'
+    """
     new_patterns = {}
     logtypes = patterns1.keys() | patterns2.keys()
     for logtype in logtypes:
         p1 = patterns1.get(logtype, [])
         p2 = patterns2.get(logtype, [])
-        new_patterns[logtype] = p1 + p2
+        if p1 + p2:
+            new_patterns[logtype] = LogExclusionMatcher(p1 + p2)
     return new_patterns
 
 
+class FieldPatternMatcher:
+    """matcher of regex patterns for one field.
+
+    CSV の text タイプのように正規表現の特殊文字を含まないパターンは集合で
+    引き、その他は一つの正規表現に結合して、フィールドの値を一度だけ検査する
+    """
+    RE_BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+
+    def __init__(self):
+        self.literals = {}
+        self.group_labels = {}
+        self.combined = None
+        self.regexes = []
+
+    def add(self, regex, label):
+        literal = self._literal_of_pattern(regex)
+        if literal is not None:
+            self.literals.setdefault(literal, label)
+        elif (regex.flags != re.UNICODE
+                or self.RE_BACKREFERENCE.search(regex.pattern)):
+            # numbered groups are shifted in combined regex
+            self.regexes.append((regex, label))
+        else:
+            self.group_labels[f'_{len(self.group_labels)}'] = (regex, label)
+
+    def compile(self):
+        if not self.group_labels:
+            return
+        try:
+            self.combined = re.compile('|'.join(
+                f'(?P<{name}>{regex.pattern})'
+                for name, (regex, label) in self.group_labels.items()))
+        except re.error:
+            # e.g. duplicated group names or inline global flags
+            self.regexes[:0] = self.group_labels.values()
+            self.group_labels = {}
+
+    def match(self, value):
+        value = str(value)
+        if self.literals:
+            # $ also matches before a newline at the end
+            label = self.literals.get(value)
+            if label is None and value.endswith('\n'):
+                label = self.literals.get(value[:-1])
+            if label is not None:
+                return label
+        if self.combined:
+            m = self.combined.match(value)
+            if m:
+                # the outermost group is closed at last
+                return self.group_labels[m.lastgroup][1]
+        for regex, label in self.regexes:
+            if regex.match(value):
+                return label
+        return None
+
+    @staticmethod
+    def _literal_of_pattern(regex):
+        pattern = regex.pattern
+        if regex.flags != re.UNICODE or not pattern.endswith('$'):
+            return None
+        text = re.sub(r'\\(.)', r'\1', pattern[:-1], flags=re.DOTALL)
+        if re.escape(text) + '$' == pattern:
+            return text
+        return None
+
+
+class LogExclusionMatcher:
+    """field-indexed matcher of log exclusion patterns of a log type.
+
+    パターン毎にログを辿るのではなく、全パターンのフィールドを木にまとめ、
+    参照されるフィールドを一度だけ読んで FieldPatternMatcher で検査する。
+    どれか一つのフィールドが一致すれば除外する。リストは先頭の要素だけを
+    検査するのは match_log_with_exclude_patterns と同じ
+
+    >>> matcher = LogExclusionMatcher([
+    ...     {'a': re.compile('111$'), 'x': {'y': re.compile('.*22$')}},
+    ...     {'x': {'z': re.compile('3+$')}},
+    ...     {'@message': re.compile('.*th$')}])
+    >>> matcher.match({'a': 111})
+    '{a: 111} with log_exclusion_patterns[0] a: 111$'
+    >>> matcher.match({'x': {'y': 'hoge222', 'z': 1}})
+    '{y: hoge222} with log_exclusion_patterns[0] x.y: .*22$'
+    >>> matcher.match({'x': [{'z': 33}, {'y': 22}]})
+    '{z: 33} with log_exclusion_patterns[1] x.z: 3+$'
+    >>> matcher.match({'a': 1112, 'x': 333})
+    >>> matcher.match_raw('/health')
+    '{@message: /health} with log_exclusion_patterns[2] @message: .*th$'
+    """
+    RAW_FIELD = '@message'
+
+    def __init__(self, log_patterns):
+        self.tree = {}
+        # @message is matched with raw log before the log is parsed
+        self.raw_matcher = None
+        for i, pattern in enumerate(log_patterns):
+            if (pattern.keys() == {self.RAW_FIELD}
+                    and isinstance(pattern[self.RAW_FIELD], re.Pattern)):
+                regex = pattern[self.RAW_FIELD]
+                if not self.raw_matcher:
+                    self.raw_matcher = FieldPatternMatcher()
+                self.raw_matcher.add(
+                    regex, f'log_exclusion_patterns[{i}] {self.RAW_FIELD}: '
+                    f'{regex.pattern}')
+            else:
+                self._add_pattern(self.tree, pattern, i, ())
+        self._compile(self.tree)
+        if self.raw_matcher:
+            self.raw_matcher.compile()
+        self.has_field_patterns = bool(self.tree)
+
+    def _add_pattern(self, tree, pattern, rule_number, path):
+        for key, value in pattern.items():
+            # node: [children, FieldPatternMatcher]
+            node = tree.setdefault(key, [{}, None])
+            if isinstance(value, dict):
+                self._add_pattern(node[0], value, rule_number, path + (key,))
+            elif isinstance(value, re.Pattern):
+                if node[1] is None:
+                    node[1] = FieldPatternMatcher()
+                dotted_key = '.'.join(path + (key, ))
+                node[1].add(value, f'log_exclusion_patterns[{rule_number}] '
+                                   f'{dotted_key}: {value.pattern}')
+
+    def _compile(self, tree):
+        for children, field_matcher in tree.values():
+            if field_matcher:
+                field_matcher.compile()
+            self._compile(children)
+
+    def match(self, log_dict):
+        """return matched field and pattern or None."""
+        return self._match(self.tree, log_dict)
+
+    def _match(self, tree, log_dict):
+        for key, (children, field_matcher) in tree.items():
+            if key not in log_dict:
+                continue
+            value = log_dict[key]
+            if field_matcher:
+                label = field_matcher.match(value)
+                if label:
+                    return f'{{{key}: {value}}} with {label}'
+            if children:
+                if isinstance(value, list):
+                    value = value[0] if value else None
+                if isinstance(value, dict):
+                    matched = self._match(children, value)
+                    if matched:
+                        return matched
+        return None
+
+    def match_raw(self, lograw):
+        """return matched pattern of @message or None."""
+        if self.raw_matcher:
+            label = self.raw_matcher.match(lograw)
+            if label:
+                return f'{{{self.RAW_FIELD}: {lograw}}} with {label}'
+        return None
+
+
 def merge_dotted_key_value_into_dict(patterns_dict, dotted_key, value):
     if not patterns_dict:
         patterns_dict = {}
@@ -1005,6 +1606,92 @@ def put_value_into_nesteddict(dotted_key, value):
     return nested_dict
 
 
+class EcsMappingPlan:
+    """compiled mapping from original fields to ECS fields.
+
+    logconfig['ecs'] の各 ECS フィールドについて、抽出元のキーと格納先のキーを
+    事前に分割しておき、ログ毎に ECS の辞書へ直接書き込む
+    """
+    def __init__(self, logconfig):
+        self.plan = []
+        for ecs_key in logconfig.get('ecs') or []:
+            original_keys = logconfig[ecs_key]
+            if isinstance(original_keys, str):
+                is_list = False
+                source_paths = [self._split_key(key)
+                                for key in original_keys.split()]
+            elif isinstance(original_keys, list):
+                is_list = True
+                source_paths = [[self._split_key(key) for key in keys.split()]
+                                for keys in original_keys]
+            else:
+                continue
+            *parents, leaf = ecs_key.split('.')
+            self.plan.append((ecs_key, tuple(parents), leaf, is_list,
+                              source_paths, '.ip' in ecs_key))
+
+    @staticmethod
+    def _split_key(dotted_key):
+        return tuple(int(key) if key.isdigit() else key
+                     for key in dotted_key.split('.'))
+
+    @staticmethod
+    def _get_value(logdata_dict, source_paths):
+        # same as value_from_nesteddict_by_dottedkeylist
+        for path in source_paths:
+            value = logdata_dict
+            for key in path:
+                try:
+                    value = value[key]
+                except (TypeError, KeyError, IndexError):
+                    value = None
+                    break
+            if value is not None and value != '':
+                return value
+
+    @staticmethod
+    def _put_value(ecs_dict, parents, leaf, value):
+        # same as merge_dicts(ecs_dict, put_value_into_nesteddict(key, value))
+        if not isinstance(value, (dict, str, list)):
+            value = str(value)
+        current = ecs_dict
+        for key in parents:
+            if not isinstance(current.get(key), dict):
+                current[key] = {}
+            current = current[key]
+        if isinstance(value, dict) and isinstance(current.get(leaf), dict):
+            merge_dicts(current[leaf], value)
+        else:
+            current[leaf] = value
+
+    def apply(self, logdata_dict, ecs_dict):
+        for ecs_key, parents, leaf, is_list, source_paths, is_ip in self.plan:
+            if not is_list:
+                v = self._get_value(logdata_dict, source_paths)
+                if isinstance(v, str) and is_ip:
+                    v = validate_ip(v, ecs_key)
+                if v == 0 or v:
+                    self._put_value(ecs_dict, parents, leaf, v)
+                continue
+            temp_list = []
+            for paths in source_paths:
+                v = self._get_value(logdata_dict, paths)
+                if isinstance(v, str):
+                    if is_ip:
+                        v = validate_ip(v, ecs_key)
+                    if v:
+                        temp_list.append(v)
+                elif isinstance(v, list):
+                    for i in v:
+                        each_v = validate_ip(i, ecs_key) if is_ip else i
+                        if each_v:
+                            temp_list.append(each_v)
+            if temp_list:
+                self._put_value(
+                    ecs_dict, parents, leaf, sorted(list(set(temp_list))))
+        return ecs_dict
+
+
 def convert_keyname_to_safe_field(obj):
     """convert keyname into safe field name.
 
@@ -8,6 +8,7 @@ __author__ = 'Akihiro Nakajima'
 __url__ = 'https://github.com/aws-samples/siem-on-amazon-opensearch-service'
 
 
+import bisect
 import configparser
 import datetime
 # import gzip
@@ -34,10 +35,11 @@ class DB():
     NOT_FILE_FRESH_DURATION = 43200   # 12 hours
     RE_IPADDR = re.compile(r'[0-9a-fA-F:.]*$')
 
-    def __init__(self, s3_session_config):
+    def __init__(self, s3_session_config, enabled=True):
+        # enabled=False creates instance without database
         self.GEOIP_BUCKET = self._get_geoip_buckent_name()
         self.s3_session_config = s3_session_config
-        has_trusted_proxy_db = self._download_database()
+        has_trusted_proxy_db = enabled and self._download_database()
         self.cur = None
         if has_trusted_proxy_db:
             with sqlite3.connect(self.DB_FILE_LOCAL) as conn_file:
@@ -55,6 +57,8 @@ class DB():
                     count = self.cur.fetchone()[0]
                     if count >= 1:
                         self.is_enabled = True
+                        self.trusted_networks = (
+                            self._create_trusted_network_table())
                     else:
                         self.is_enabled = False
                 except Exception:
@@ -69,7 +73,7 @@ class DB():
         if (self.cur
                 and isinstance(ip_str, str)
                 and self.RE_IPADDR.match(ip_str)):
-            return self._query_db(ip_str)
+            return self._match_trusted_network(ip_str)
         else:
             return None
 
@@ -127,7 +131,9 @@ class DB():
                 return True
 
         if not os.path.isfile(self.DB_FILE_LOCAL):
-            _s3 = boto3.resource('s3', config=self.s3_session_config)
+            # DB is created in thread. default session is not thread-safe
+            _s3 = boto3.session.Session().resource(
+                's3', config=self.s3_session_config)
             bucket = _s3.Bucket(self.GEOIP_BUCKET)
             try:
                 bucket.download_file(self.DB_FILE_S3KEY, self.DB_FILE_LOCAL)
@@ -169,7 +175,57 @@ class DB():
                 del d[key]
         return d
 
+    def _create_trusted_network_table(self):
+        """load trusted networks as sorted and disjoint ranges.
+
+        重複・隣接するネットワークは結合し、IP バージョン毎に開始値と
+        終了値のリストにする。bisect で 1 回探すだけで判定できる
+        """
+        networks = {4: [], 6: []}
+        self.cur.execute(
+            """SELECT version, v6_network1_start, v6_network1_end,
+                v6_network2_start, v6_network2_end,
+                network_start, network_end
+            FROM ipaddress""")
+        for res in self.cur.fetchall():
+            (version, v6_network1_start, v6_network1_end, v6_network2_start,
+             v6_network2_end, network_start, network_end) = res
+            if version == 6:
+                network_start = ((v6_network1_start << 80)
+                                 | (v6_network2_start << 32) | network_start)
+                network_end = ((v6_network1_end << 80)
+                               | (v6_network2_end << 32) | network_end)
+            elif version != 4:
+                continue
+            networks[version].append((network_start, network_end))
+        trusted_networks = {}
+        for version, ranges in networks.items():
+            starts = []
+            ends = []
+            for network_start, network_end in sorted(ranges):
+                if ends and network_start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], network_end)
+                else:
+                    starts.append(network_start)
+                    ends.append(network_end)
+            trusted_networks[version] = (starts, ends)
+        logger.info(f'{len(networks[4]) + len(networks[6])} trusted networks '
+                    f'were merged into {len(trusted_networks[4])} IPv4 and '
+                    f'{len(trusted_networks[6])} IPv6 ranges')
+        return trusted_networks
+
+    def _match_trusted_network(self, ip_str):
+        try:
+            ip = ipaddress.ip_address(ip_str)
+            ip_int = int(ip)
+        except Exception:
+            return None
+        starts, ends = self.trusted_networks[ip.version]
+        i = bisect.bisect_right(starts, ip_int) - 1
+        return i >= 0 and ends[i] >= ip_int
+
     def _query_db(self, ip_str):
+        # SQLite で検索する以前の方法。benchmark.py の比較で使う
         try:
             ip = ipaddress.ip_address(ip_str)
             ip_int = int(ip)
@@ -0,0 +1,61 @@
+import io
+import json
+
+import pytest
+
+
+class FakeS3Client:
+    """S3 client which returns one object from memory."""
+    def __init__(self, body):
+        self.body = body
+        self.calls = []
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.calls.append(Range)
+        body = self.body
+        if Range:
+            start = int(Range.split('=')[1].split('-')[0])
+            body = body[start:]
+        return {'Body': io.BytesIO(body),
+                'ResponseMetadata': {
+                    'HTTPHeaders': {'content-length': str(len(body))}}}
+
+
+class FakeSQSQueue:
+    def __init__(self):
+        self.messages = []
+
+    def send_messages(self, Entries):
+        self.messages.extend(json.loads(x['MessageBody']) for x in Entries)
+        return {'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+
+@pytest.fixture
+def s3_client():
+    return FakeS3Client
+
+
+@pytest.fixture
+def sqs_queue():
+    return FakeSQSQueue()
+
+
+@pytest.fixture
+def logconfig():
+    return {
+        's3_key_ignored': None, 'file_format': 'text',
+        'index_name': 'log-test', 'via_cwl': False, 'via_firelens': False,
+        'max_log_count': 100000, 'file_timestamp_format': None,
+        's3_streaming_threshold': 104857600, 'text_header_line_number': 0,
+        'csv_delimiter': '', 'ignore_container_stderr': False,
+    }
+
+
+def s3_record(key, body):
+    return {'s3': {'bucket': {'name': 'bucket'},
+                   'object': {'key': key, 'size': len(body)}}}
+
+
+@pytest.fixture
+def record():
+    return s3_record
@@ -0,0 +1,87 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import siem
+from siem import fileformat_parquet
+
+
+def parquet_bytes(table):
+    buf = io.BytesIO()
+    pq.write_table(table, buf)
+    return buf.getvalue()
+
+
+@pytest.fixture
+def no_parquet_libraries(monkeypatch):
+    monkeypatch.setattr(fileformat_parquet, 'pq', None)
+    monkeypatch.setattr(fileformat_parquet, 'pd', None)
+    monkeypatch.setattr(fileformat_parquet, 'np', None)
+    monkeypatch.setattr(fileformat_parquet, 'is_imported', True)
+
+
+def test_extract_log_without_pyarrow_and_pandas(no_parquet_libraries):
+    body = parquet_bytes(pa.table({'a': [1, 2, 3]}))
+    parquet = fileformat_parquet.FileFormatParquet(
+        io.BytesIO(body), {}, 'test')
+    assert list(parquet.extract_log(1, 10)) == []
+    assert parquet.log_count == 0
+
+
+def test_object_is_skipped_without_pyarrow_and_pandas(
+        no_parquet_libraries, logconfig, s3_client, sqs_queue, record):
+    body = parquet_bytes(pa.table({'a': [1, 2, 3]}))
+    logconfig['file_format'] = 'parquet'
+    logfile = siem.LogS3(record('test.parquet', body), 'bucket',
+                         'test.parquet', 'test', logconfig, s3_client(body),
+                         sqs_queue)
+    assert list(logfile) == []
+    assert logfile.is_ignored
+    assert sqs_queue.messages == []
+
+
+def test_nanosecond_timestamp_without_pandas(tmp_path):
+    table = pa.table({
+        'time': pa.array([1714557600123456789, None],
+                         pa.timestamp('ns', tz='UTC')),
+        'event': pa.array([{'created': 1714557600000000001}, None],
+                          pa.struct([('created', pa.timestamp('ns'))])),
+    })
+    path = tmp_path / 'test.parquet'
+    path.write_bytes(parquet_bytes(table))
+    # pyarrow converts timestamp[ns] with pandas if it can be imported,
+    # so pandas is hidden in another process
+    script = textwrap.dedent(f"""
+        import json
+        import sys
+
+        class NoPandas:
+            def find_spec(self, name, path=None, target=None):
+                if name.split('.')[0] == 'pandas':
+                    raise ModuleNotFoundError(name)
+
+        sys.meta_path.insert(0, NoPandas())
+        from siem import fileformat_parquet
+
+        with open({str(path)!r}, 'rb') as f:
+            parquet = fileformat_parquet.FileFormatParquet(f, {{}}, 'test')
+            logs = [x[1] for x in parquet.extract_log(1, 2)]
+        assert 'pandas' not in sys.modules
+        print(json.dumps(logs))
+    """)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    result = subprocess.run([sys.executable, '-c', script], env=env,
+                            capture_output=True, text=True, check=True)
+    logs = json.loads(result.stdout.splitlines()[-1])
+    assert logs == [
+        {'time': '2024-05-01T10:00:00.123456+00:00',
+         'event': {'created': '2024-05-01T10:00:00'}},
+        {},
+    ]
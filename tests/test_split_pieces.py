@@ -0,0 +1,67 @@
+import gzip
+import re
+
+import pytest
+
+import siem
+
+MAX_LOG_COUNT = 7
+
+
+def load_all_pieces(body, key, logconfig, s3_client, sqs_queue, record):
+    """load the first piece and every piece sent to SQS."""
+    def load(message):
+        logfile = siem.LogS3(message, 'bucket', key, 'test', logconfig,
+                             s3_client(body), sqs_queue)
+        logs = [lograw for lograw, logdict, logmeta in logfile]
+        logfile.send_split_pieces()
+        return logs
+
+    logs = load(record(key, body))
+    for message in list(sqs_queue.messages):
+        logs.extend(load(message))
+    return logs
+
+
+@pytest.mark.parametrize('is_streaming', [False, True])
+@pytest.mark.parametrize('is_gzip', [False, True])
+@pytest.mark.parametrize('header_line_number', [0, 1, 2])
+def test_text_pieces_cover_file_once(
+        header_line_number, is_gzip, is_streaming, logconfig, s3_client,
+        sqs_queue, record):
+    lines = ([f'header{i}' for i in range(header_line_number)]
+             + [f'log{i}' for i in range(50)])
+    body = ('\n'.join(lines) + '\n').encode()
+    if is_gzip:
+        body = gzip.compress(body)
+    logconfig.update({
+        'max_log_count': MAX_LOG_COUNT,
+        'text_header_line_number': header_line_number,
+        'log_pattern': re.compile(r'(?P<message>.*)'),
+        's3_streaming_threshold': 0 if is_streaming else 104857600})
+    logs = load_all_pieces(
+        body, 'test.log', logconfig, s3_client, sqs_queue, record)
+    assert all('start_offset' in x['siem'] for x in sqs_queue.messages)
+    assert sorted(logs) == sorted(lines[header_line_number:])
+
+
+@pytest.mark.parametrize('is_streaming', [False, True])
+@pytest.mark.parametrize('is_gzip', [False, True])
+@pytest.mark.parametrize('csv_delimiter', [',', ''])
+@pytest.mark.parametrize('log_count', [49, 50, MAX_LOG_COUNT])
+def test_csv_pieces_cover_file_once(
+        log_count, csv_delimiter, is_gzip, is_streaming, logconfig,
+        s3_client, sqs_queue, record):
+    delimiter = csv_delimiter or ' '
+    lines = ([delimiter.join(['name', 'value'])]
+             + [delimiter.join([f'log{i}', str(i)]) for i in range(log_count)])
+    body = ('\n'.join(lines) + '\n').encode()
+    if is_gzip:
+        body = gzip.compress(body)
+    logconfig.update({
+        'file_format': 'csv', 'csv_delimiter': csv_delimiter,
+        'max_log_count': MAX_LOG_COUNT,
+        's3_streaming_threshold': 0 if is_streaming else 104857600})
+    logs = load_all_pieces(
+        body, 'test.csv', logconfig, s3_client, sqs_queue, record)
+    assert sorted(logs) == sorted(lines[1:])